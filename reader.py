@@ -0,0 +1,264 @@
+import csv
+import math
+import os
+import yaml
+import numpy as np
+import matplotlib.pyplot as plt
+from PIL import Image
+
+from simulator import (PackedBW, VectorScenes, loadIndexedPNG, recolor)
+
+# Columns written by the simulate* drivers
+CATEGORY_COLUMNS = ["slope_material", "block_material", "env"]
+INDEX_VERSION = 2
+
+class DatasetReader:
+	'''
+	Reader for a generated dataset folder (metadata.csv plus the samples).
+	A persistent index over the metadata is kept in metadata_index.npz,
+	with posting lists for materials, env, label and 1 degree angle
+	buckets, so filter queries only touch the matching rows.
+	'''
+	def __init__(self, folder, config=None, resolution=256, free=None):
+		'''
+		folder:
+			Description:
+				Dataset folder, e.g. ../DATASET/samples/
+		config:
+			Description:
+				Physics yaml of the run, only needed for near_critical
+				queries on datasets without dataset.yaml. Overrides the
+				friction coefficients recorded in dataset.yaml.
+		resolution:
+			Description:
+				Image size used to rasterize vector datasets.
+		free:
+			Description:
+				Whether the dataset uses the free pivot geometry, where
+				angles above 45 degrees act as 90-angle. Taken from
+				dataset.yaml when not given.
+		'''
+		self.folder = os.path.join(folder, "")
+		self.resolution = resolution
+		self.frictionCoeff = None
+		self.free = False
+		if os.path.exists(self.folder + 'dataset.yaml'):
+			with open(self.folder + 'dataset.yaml') as file:
+				info = yaml.safe_load(file)
+			self.frictionCoeff = info['friction_coeff']
+			self.free = info['free']
+		if config is not None:
+			with open(config) as file:
+				self.frictionCoeff = yaml.load(file, Loader=yaml.FullLoader)['materials']['friction_coeff']
+		if free is not None:
+			self.free = free
+		self._loadIndex()
+		self._packed = None
+		self._scenes = None
+		if os.path.exists(self.folder + 'packed.npy'):
+			self._packed = PackedBW(self.folder + 'packed.npy')
+		elif os.path.exists(self.folder + 'packed.npz'):
+			self._packed = PackedBW(self.folder + 'packed.npz')
+		elif os.path.exists(self.folder + 'scenes.npy'):
+			self._scenes = VectorScenes(self.folder + 'scenes.npy',
+										resolution=resolution)
+
+	def __len__(self):
+		return len(self.columns["id"])
+
+	def _loadIndex(self):
+		'''
+		Load metadata_index.npz, rebuilding it when metadata.csv changed.
+		'''
+		metadata = self.folder + 'metadata.csv'
+		path = self.folder + 'metadata_index.npz'
+		stat = os.stat(metadata)
+		stamp = np.array([INDEX_VERSION, stat.st_size, stat.st_mtime_ns])
+		if os.path.exists(path):
+			with np.load(path, allow_pickle=False) as data:
+				if np.array_equal(data["stamp"], stamp):
+					self._fromArrays(dict(data))
+					return
+		arrays = self._buildIndex(metadata)
+		arrays["stamp"] = stamp
+		np.savez(path, **arrays)
+		self._fromArrays(arrays)
+
+	def _buildIndex(self, metadata):
+		with open(metadata) as _file:
+			_file_r = csv.reader(_file, delimiter=',')
+			headers = next(_file_r)
+			rows = list(_file_r)
+		raw = {h: [row[i] for row in rows] for i, h in enumerate(headers)}
+		arrays = {"col_image": np.array(raw["image"]),
+				  "col_id": np.array([int(name.split("_")[1]) for name in raw["image"]],
+									 dtype=np.int64),
+				  "col_label": np.array([v == "True" for v in raw["label"]], dtype=bool)}
+		for h in CATEGORY_COLUMNS:
+			vocab, codes = np.unique(np.array(raw[h]), return_inverse=True)
+			arrays["vocab_" + h] = vocab
+			arrays["col_" + h] = codes.astype(np.int32)
+		for h in headers:
+			if h not in ["image", "label"] + CATEGORY_COLUMNS:
+				arrays["col_" + h] = np.array(raw[h], dtype=np.float64)
+		arrays["col_angle_bucket"] = np.floor(arrays["col_angle"]).astype(np.int32)
+		arrays["col_label_code"] = arrays["col_label"].astype(np.int32)
+		# posting lists, rows of each value are contiguous in order
+		for h in CATEGORY_COLUMNS + ["label_code", "angle_bucket"]:
+			codes = arrays["col_" + h]
+			order = np.argsort(codes, kind='stable')
+			values, starts = np.unique(codes[order], return_index=True)
+			arrays["post_" + h] = order
+			arrays["postval_" + h] = values
+			arrays["poststart_" + h] = np.append(starts, len(codes))
+		# rows are keyed by sample ID, and by (ID, block) for multi block
+		# datasets, which have one row per block of a scene
+		blocks = arrays["col_block"].astype(np.int64) if "col_block" in arrays else 0
+		stride = int(np.max(blocks)) + 1 if "col_block" in arrays else 1
+		keys = arrays["col_id"]*stride + blocks
+		order = np.argsort(keys, kind='stable')
+		if np.any(np.diff(keys[order]) == 0):
+			raise ValueError("Duplicate sample keys in %s" % metadata)
+		arrays["id_order"] = order
+		arrays["key_stride"] = np.array(stride)
+		return arrays
+
+	def _fromArrays(self, arrays):
+		self.columns = {k[4:]: v for k, v in arrays.items() if k.startswith("col_")}
+		self.vocab = {h: list(arrays["vocab_" + h]) for h in CATEGORY_COLUMNS}
+		self.postings = {}
+		for h in CATEGORY_COLUMNS + ["label_code", "angle_bucket"]:
+			self.postings[h] = (arrays["post_" + h], arrays["postval_" + h],
+								arrays["poststart_" + h])
+		self.idOrder = arrays["id_order"]
+		self.keyStride = int(arrays["key_stride"])
+		keys = self.columns["id"]*self.keyStride
+		if "block" in self.columns:
+			keys = keys + self.columns["block"].astype(np.int64)
+		self.sortedKeys = keys[self.idOrder]
+
+	def _posting(self, column, codes):
+		'''
+		Sorted row positions whose column takes one of the codes.
+		'''
+		order, values, starts = self.postings[column]
+		found = np.searchsorted(values, codes)
+		parts = [order[starts[i]:starts[i+1]]
+				 for i, code in zip(found, codes)
+				 if i < len(values) and values[i] == code]
+		if not parts:
+			return np.zeros(0, dtype=np.int64)
+		return np.sort(np.concatenate(parts))
+
+	def query(self, slope_material=None, block_material=None, env=None,
+			  label=None, angle=None, near_critical=None):
+		'''
+		Row positions, in metadata order, matching every given filter.
+		slope_material, block_material, env - a name or a list of names
+		label - True for samples that slip
+		angle - (low, high) angle range in degrees, both included
+		near_critical - degrees, keep samples whose angle is within this
+			distance of the critical angle atan(friction_coeff) of their
+			slope material, or of 90 minus it above 45 degrees on free
+			pivot datasets
+		'''
+		candidates = None
+		def narrow(positions):
+			if candidates is None:
+				return positions
+			return np.intersect1d(candidates, positions, assume_unique=True)
+		for h, wanted in zip(CATEGORY_COLUMNS, [slope_material, block_material, env]):
+			if wanted is None:
+				continue
+			names = [wanted] if isinstance(wanted, str) else list(wanted)
+			codes = [self.vocab[h].index(n) for n in names if n in self.vocab[h]]
+			candidates = narrow(self._posting(h, codes))
+		if label is not None:
+			candidates = narrow(self._posting("label_code", [int(bool(label))]))
+		if angle is not None:
+			low, high = angle
+			buckets = np.arange(math.floor(low), math.floor(high) + 1)
+			positions = self._posting("angle_bucket", buckets)
+			values = self.columns["angle"][positions]
+			candidates = narrow(positions[(values >= low) & (values <= high)])
+		if candidates is None:
+			candidates = np.arange(len(self))
+		if near_critical is not None:
+			if self.frictionCoeff is None:
+				raise ValueError("near_critical needs the physics config of the dataset")
+			critical = np.degrees(np.arctan(np.array(
+						[self.frictionCoeff[m] for m in self.vocab["slope_material"]])))
+			slope = self.columns["slope_material"][candidates]
+			angles = self.columns["angle"][candidates]
+			if self.free:
+				# slipOrNotFreePivot tilts by 90-angle above 45 degrees
+				angles = np.where(angles > 45.0, 90.0 - angles, angles)
+			margin = np.abs(angles - critical[slope])
+			candidates = candidates[margin <= near_critical]
+		return candidates
+
+	def positions(self, ids, blocks=None):
+		'''
+		Row positions of sample IDs, for random access in shuffled order.
+		blocks - block of each ID, required on multi block datasets where
+			every block of a scene has its own row
+		'''
+		ids = np.asarray(ids, dtype=np.int64)
+		if blocks is None:
+			if "block" in self.columns:
+				raise ValueError("Rows of a multi block dataset are keyed by (id, block)")
+			blocks = 0
+		keys = ids*self.keyStride + np.asarray(blocks, dtype=np.int64)
+		sorted_keys = self.sortedKeys
+		found = np.searchsorted(sorted_keys, keys)
+		if np.any(found >= len(sorted_keys)) or np.any(sorted_keys[np.minimum(found, len(sorted_keys) - 1)] != keys):
+			raise KeyError("Unknown sample id in %s" % ids)
+		return self.idOrder[found]
+
+	def rows(self, positions):
+		'''
+		Metadata columns of the given rows, categories decoded to names.
+		'''
+		out = {}
+		for h, values in self.columns.items():
+			if h in CATEGORY_COLUMNS:
+				out[h] = np.array(self.vocab[h])[values[positions]]
+			elif h not in ["label_code", "angle_bucket"]:
+				out[h] = values[positions]
+		return out
+
+	def packed(self, positions):
+		'''
+		Raw bit-packed images of a packed dataset. A slice gives a view of
+		the shard without copying, use unpackBW to expand.
+		'''
+		if self._packed is None:
+			raise ValueError("%s is not a packed dataset" % self.folder)
+		return self._packed.packed[positions]
+
+	def images(self, positions):
+		'''
+		Images of the given rows, stacked, read from the packed shard, the
+		vector shard or the PNG files, whichever the dataset holds.
+		'''
+		positions = np.atleast_1d(positions)
+		if self._packed is not None:
+			return self._packed[positions]
+		if self._scenes is not None:
+			return np.stack([self._scenes[p] for p in positions])
+		return np.stack([self._readPNG(self.columns["image"][p]) for p in positions])
+
+	def image(self, sample_id, block=None):
+		if block is None and "block" in self.columns:
+			# every block row of a scene points to the same image
+			block = 0
+		return self.images(self.positions([sample_id],
+										  None if block is None else [block]))[0]
+
+	def _readPNG(self, name):
+		path = self.folder + name + '.png'
+		with Image.open(path) as png:
+			paletted = png.mode == "P"
+		if paletted:
+			return recolor(*loadIndexedPNG(path))
+		return (plt.imread(path)[..., :3]*255).astype(np.uint8)
@@ -1,17 +1,49 @@
 import matplotlib.pyplot as plt
+import matplotlib.colors as mcolors
+from PIL import Image
+import numpy as np
 import math
 import yaml
 import pprint
 import random
 import csv
+from collections import OrderedDict
+import io
+import copy
+import contextlib
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+import resource
+import tracemalloc
+import json
+import threading
+import http.server
 from tqdm import tqdm
 
+# Scenes are drawn in a square frame of this size in data units
+FRAME_SIZE = 2+10.0
+# Outline width of BW scenes in data units, close to the 5pt stroke of _drawBW
+STROKE_WIDTH = 0.22
+
+SCENE_DTYPE = np.dtype([("id", np.int32),
+						("tri", np.float32, (3, 2)),
+						("rec", np.float32, (4, 2)),
+						("slope_color", np.uint8, (3,)),
+						("block_color", np.uint8, (3,)),
+						("env_color", np.uint8, (3,)),
+						("outline", np.bool_)])
+
 class FrictionSimulationEnginer:
 	'''
 	This is the main class for friction simulation.
 	'''
 	def __init__(self, materialCoeffMapping, materialDensityMapping,
-				 materialColorMapping, envGMapping, envColorMapping):
+				 materialColorMapping, envGMapping, envColorMapping,
+				 uncertainty=None):
 		'''
 		materialCoeffMapping: 
 			Description:
@@ -36,12 +68,21 @@ class FrictionSimulationEnginer:
 			Description:
 				The color for different enviroment.
 				{env_name : color}
+		uncertainty:
+			Description:
+				Optional spread of the values above, used by
+				slipProbability. Missing entries are exact.
+				{"friction_coeff"|"density"|"gravity_accel" :
+					{name : {"dist" : "normal", "std" : 0.03}}}
+				dist is one of normal (std), uniform (half_width)
+				or lognormal (sigma, multiplicative).
 		'''
 		self.materialCoeffMapping = materialCoeffMapping
 		self.materialDensityMapping = materialDensityMapping
 		self.materialColorMapping = materialColorMapping
 		self.envGMapping = envGMapping
 		self.envColorMapping = envColorMapping
+		self.uncertainty = uncertainty or {}
 
 	def _drawTriangle(self, angle):
 		'''
@@ -196,6 +237,172 @@ class FrictionSimulationEnginer:
 		return [[point0_x,point0_y], [point1_x,point1_y],
 				[point2_x,point2_y], [point3_x,point3_y]]
 
+	def _drawTriangleBatch(self, angles):
+		'''
+		Vectorized _drawTriangle.
+		angles - (N,) angles in degrees
+		return - (N,3,2) vertices, points ordered as in _drawTriangle
+		'''
+		base_x_y = 1.0
+		slope_length = 10
+
+		angle_pi = np.radians(np.asarray(angles, dtype=float))
+		tri = np.full(angle_pi.shape + (3, 2), base_x_y)
+		tri[:, 1, 1] += slope_length*np.sin(angle_pi)
+		tri[:, 2, 0] += slope_length*np.cos(angle_pi)
+		return tri
+
+	def _drawTriangleFreePivotBatch(self, angles):
+		'''
+		Vectorized _drawTriangleFreePivot.
+		angles - (N,) angles in degrees
+		return - (N,3,2) vertices, points ordered as in _drawTriangle
+		'''
+		base_x_y = 1.0
+		base_length = 10
+
+		angle_pi = np.radians(np.asarray(angles, dtype=float))
+		tri = np.full(angle_pi.shape + (3, 2), base_x_y)
+		tri[:, 1, 0] += base_length*np.sin(angle_pi)*np.sin(angle_pi)
+		tri[:, 1, 1] += base_length*np.sin(angle_pi)*np.cos(angle_pi)
+		tri[:, 2, 0] += base_length
+		return tri
+
+	def _placeBlockBatch(self, base, along, normal, b_widths, b_heights):
+		'''
+		Corners of blocks standing on a slope face.
+		base - (N,2) middle of the block bottom edge
+		along - (N,2) unit vector along the face, from point (0) to (3)
+		normal - (N,2) unit vector out of the face, from point (0) to (1)
+		return - (N,4,2) vertices, points ordered as in _drawBlock
+		'''
+		half = np.asarray(b_widths, dtype=float).reshape(-1, 1)*0.5*along
+		top = np.asarray(b_heights, dtype=float).reshape(-1, 1)*normal
+		return np.stack([base - half, base - half + top,
+						 base + half + top, base + half], axis=1)
+
+	def _drawBlockBatch(self, tris, angles, b_widths, b_heights, offsets=0.5):
+		'''
+		Vectorized _drawBlock, by default the block sits at the middle of
+		the slope.
+		tris - (N,3,2) from _drawTriangleBatch
+		offsets - position of the block center along the slope face, 0 at
+			the pivot (1) and 1 at the bottom (2)
+		return - (N,4,2) vertices
+		'''
+		angle_pi = np.radians(np.asarray(angles, dtype=float))
+		sin, cos = np.sin(angle_pi), np.cos(angle_pi)
+		offsets = np.asarray(offsets, dtype=float).reshape(-1, 1)
+		base = tris[:, 1] + offsets*(tris[:, 2] - tris[:, 1])
+		along = np.stack([cos, -sin], axis=1)
+		normal = np.stack([sin, cos], axis=1)
+		return self._placeBlockBatch(base, along, normal, b_widths, b_heights)
+
+	def _drawBlockFreePivotBatch(self, tris, angles, b_widths, b_heights):
+		'''
+		Vectorized _drawBlockFreePivot. Up to 45 degrees the block sits on
+		the right face of the triangle, above that on the left face. Both
+		cases are computed at once and selected per scene with a mask.
+		tris - (N,3,2) from _drawTriangleFreePivotBatch
+		return - (N,4,2) vertices
+		'''
+		angles = np.asarray(angles, dtype=float)
+		steep = angles > 45.0
+		angle_pi = np.radians(np.where(steep, 90 - angles, angles))
+		sin, cos = np.sin(angle_pi), np.cos(angle_pi)
+		pivot_x = tris[:, 1, 0]
+		base_x = np.where(steep,
+						  tris[:, 0, 0] + (pivot_x - tris[:, 0, 0])*0.5,
+						  pivot_x + (tris[:, 2, 0] - pivot_x)*0.5)
+		base_y = tris[:, 0, 1] + (tris[:, 1, 1] - tris[:, 0, 1])*0.5
+		base = np.stack([base_x, base_y], axis=1)
+		along = np.stack([cos, np.where(steep, sin, -sin)], axis=1)
+		normal = np.stack([np.where(steep, -sin, sin), cos], axis=1)
+		return self._placeBlockBatch(base, along, normal, b_widths, b_heights)
+
+	def _inFrameBatch(self, vertices):
+		'''
+		return - (N,) True where every vertex lies inside the 0..FRAME_SIZE
+			frame that _draw shows.
+		'''
+		return np.all((vertices >= 0) & (vertices <= FRAME_SIZE), axis=(1, 2))
+
+	def composeMultiBlock(self, angles, b_widths, b_heights, offsets):
+		'''
+		Place K blocks on the slope face of N candidate scenes and test all
+		of them at once. A scene is valid when every block stands fully on
+		the face, no two blocks overlap and everything stays in the frame.
+		Blocks share the face, so overlap is an interval test along it.
+		angles - (N,)
+		b_widths, b_heights, offsets - (N,K), offsets as in _drawBlockBatch
+		return - (tris (N,3,2), recs (N,K,4,2), valid (N,))
+		'''
+		slope_length = 10
+
+		angles = np.asarray(angles, dtype=float)
+		b_widths = np.asarray(b_widths, dtype=float)
+		n, k = b_widths.shape
+		tris = self._drawTriangleBatch(angles)
+		recs = self._drawBlockBatch(np.repeat(tris, k, axis=0),
+									np.repeat(angles, k), b_widths.ravel(),
+									np.asarray(b_heights, dtype=float).ravel(),
+									np.asarray(offsets, dtype=float).ravel()
+									).reshape(n, k, 4, 2)
+		center = np.asarray(offsets, dtype=float)*slope_length
+		low = center - b_widths*0.5
+		high = center + b_widths*0.5
+		on_face = np.all((low >= 0) & (high <= slope_length), axis=1)
+		order = np.argsort(center, axis=1)
+		low = np.take_along_axis(low, order, axis=1)
+		high = np.take_along_axis(high, order, axis=1)
+		apart = np.all(low[:, 1:] >= high[:, :-1], axis=1)
+		in_frame = self._inFrameBatch(recs.reshape(n, k*4, 2))
+		return tris, recs, on_face & apart & in_frame
+
+	def sampleMultiBlock(self, n, blocks, rng=None, max_rounds=100):
+		'''
+		Draw n valid scenes with the given number of blocks by rejection,
+		candidates are generated and tested in batches.
+		return - {"angle" (n,), "b_width", "b_height", "offset" (n,blocks),
+				  "tri" (n,3,2), "rec" (n,blocks,4,2)}
+		'''
+		rng = np.random.default_rng(rng)
+		kept = []
+		total = 0
+		for _ in range(max_rounds):
+			if total >= n:
+				break
+			m = max(4*(n - total), 64)
+			angles = rng.uniform(1, 50, m)
+			b_heights = rng.uniform(0.5, 2, (m, blocks))
+			b_widths = b_heights + rng.uniform(0, 1, (m, blocks))
+			offsets = rng.uniform(0, 1, (m, blocks))
+			tris, recs, valid = self.composeMultiBlock(angles, b_widths,
+													   b_heights, offsets)
+			kept.append({"angle": angles[valid], "b_width": b_widths[valid],
+						 "b_height": b_heights[valid], "offset": offsets[valid],
+						 "tri": tris[valid], "rec": recs[valid]})
+			total += int(valid.sum())
+		if total < n:
+			raise ValueError("Could only place %d of %d scenes with %d blocks" % (
+							 total, n, blocks))
+		return {key: np.concatenate([part[key] for part in kept])[:n]
+				for key in kept[0]}
+
+	def sceneGeometryBatch(self, angles, b_widths, b_heights, free=False):
+		'''
+		Geometry of many scenes at once.
+		return - (tris (N,3,2), recs (N,4,2), in_frame (N,))
+		'''
+		if not free:
+			tris = self._drawTriangleBatch(angles)
+			recs = self._drawBlockBatch(tris, angles, b_widths, b_heights)
+		else:
+			tris = self._drawTriangleFreePivotBatch(angles)
+			recs = self._drawBlockFreePivotBatch(tris, angles,
+												 b_widths, b_heights)
+		return tris, recs, self._inFrameBatch(recs)
+
 	def _draw(self, tri, rec, material, env,
 			  stroke_size=5.0, show=False):
 		'''
@@ -266,6 +473,53 @@ class FrictionSimulationEnginer:
 		
 		return plt		
 
+	def _drawMulti(self, tri, recs, material, env,
+				   stroke_size=5.0, bw=False, show=False):
+		'''
+		Same as _draw (_drawBW with bw=True) for a slope with several
+		blocks, all blocks go to the figure in one call.
+		material - {"slope" : name, "block" : [name for every block]}
+		'''
+		if not bw:
+			slope_col = self.materialColorMapping[material["slope"]]
+			block_cols = [self.materialColorMapping[m] for m in material["block"]]
+			env_col = self.envColorMapping[env]
+		else:
+			slope_col = "white"
+			block_cols = ["white"]*len(recs)
+			env_col = "black"
+
+		draw = plt.plot if bw else plt.fill
+		fig, ax = plt.subplots()
+		# draw triangle
+		draw([tri[0][0],tri[1][0],tri[2][0],tri[0][0]],
+			 [tri[0][1],tri[1][1],tri[2][1],tri[0][1]],
+			 slope_col, linewidth=stroke_size)
+		# draw blocks
+		args = []
+		for rec, block_col in zip(recs, block_cols):
+			args += [[rec[0][0],rec[1][0],rec[2][0],rec[3][0],rec[0][0]],
+					 [rec[0][1],rec[1][1],rec[2][1],rec[3][1],rec[0][1]],
+					 block_col]
+		draw(*args, linewidth=stroke_size)
+		# set for figures
+		plt.xlim((0,2+10.0))
+		plt.ylim((0,2+10.0))
+		plt.xticks([], [])
+		plt.yticks([], [])
+		plt.gca().set_aspect('equal', adjustable='box')
+		plt.gca().set_facecolor(env_col)
+
+		ax.spines['top'].set_visible(False)
+		ax.spines['right'].set_visible(False)
+		ax.spines['bottom'].set_visible(False)
+		ax.spines['left'].set_visible(False)
+
+		if show:
+			plt.show()
+
+		return plt
+
 	def generateSample(self, material={"block":"wood", "slope":"wood"},
 					   angle=30.0,
 					   b_width=3.0, b_height=3.0,
@@ -299,6 +553,184 @@ class FrictionSimulationEnginer:
 							  b_width=b_width, b_height=b_height)
 		return self._drawBW(tri, rec, env=env, material=material, show=show)
 
+	def _projectPoints(self, points, plot):
+		'''
+		Project data-space points into the pixel space of the drawn axes.
+		The origin is the top-left corner of the saved image, matching the
+		PNG written with bbox_inches='tight'.
+		return - (points in pixels, (height, width) of the axes in pixels)
+		'''
+		ax = plot.gca()
+		box = ax.get_window_extent()
+		pix = ax.transData.transform(np.asarray(points, dtype=float))
+		pix[:, 0] -= box.x0
+		pix[:, 1] = box.y1 - pix[:, 1]
+		# savefig truncates the tight bounding box to whole pixels
+		return pix, (int(box.height), int(box.width))
+
+	def generateAnnotation(self, tri, rec, plot, size=None):
+		'''
+		Segmentation masks and keypoints for a scene that has just been drawn
+		into plot. The vertices are projected with the same transform used to
+		rasterize the figure, so no second render is needed. The block is
+		drawn on top of the slope, so it is removed from the slope mask.
+		size - (height, width) of the saved image, when known it is used
+			instead of the size of the axes
+		return - {"size", "keypoints", "slope", "block"}, keypoints are the
+			three triangle points followed by the four block points.
+		'''
+		keypoints, axes_size = self._projectPoints(list(tri) + list(rec), plot)
+		return pixelAnnotation(keypoints, size or axes_size)
+
+	def annotateSample(self, plot, angle=30.0, b_width=3.0, b_height=3.0,
+					   free=False, size=None):
+		'''
+		Annotation for a sample produced by generateSample* with the same
+		arguments. Only the vertices are recomputed, the figure is reused.
+		'''
+		if not free:
+			tri = self._drawTriangle(angle=angle)
+			rec = self._drawBlock(tri, angle=angle,
+								  b_width=b_width, b_height=b_height)
+		else:
+			tri = self._drawTriangleFreePivot(angle=angle)
+			rec = self._drawBlockFreePivot(tri, angle=angle,
+								  b_width=b_width, b_height=b_height)
+		return self.generateAnnotation(tri, rec, plot, size=size)
+
+	def sceneRecord(self, index, material={"block":"wood", "slope":"wood"},
+					angle=30.0,
+					b_width=3.0, b_height=3.0,
+					env="earth",
+					free=False, bw=False):
+		'''
+		Compact vector description of a sample, one row of SCENE_DTYPE.
+		Colors are resolved here so that the record can be rasterized
+		without the yaml config.
+		'''
+		if not free:
+			tri = self._drawTriangle(angle=angle)
+			rec = self._drawBlock(tri, angle=angle,
+								  b_width=b_width, b_height=b_height)
+		else:
+			tri = self._drawTriangleFreePivot(angle=angle)
+			rec = self._drawBlockFreePivot(tri, angle=angle,
+								  b_width=b_width, b_height=b_height)
+		if not bw:
+			slope_col = self.materialColorMapping[material["slope"]]
+			block_col = self.materialColorMapping[material["block"]]
+			env_col = self.envColorMapping[env]
+		else:
+			slope_col = "white"
+			block_col = "white"
+			env_col = "black"
+		to_rgb = lambda col: np.round(np.array(mcolors.to_rgb(col))*255).astype(np.uint8)
+		return (index, tri, rec, to_rgb(slope_col), to_rgb(block_col),
+				to_rgb(env_col), bw)
+
+	def _drawParameter(self, kind, name, mean, size, rng):
+		'''
+		Draws of one config value following its uncertainty entry.
+		'''
+		spec = self.uncertainty.get(kind, {}).get(name)
+		if spec is None:
+			return np.full(size, mean, dtype=float)
+		dist = spec.get("dist", "normal")
+		if dist == "normal":
+			values = rng.normal(mean, spec["std"], size)
+		elif dist == "uniform":
+			values = rng.uniform(mean - spec["half_width"],
+								 mean + spec["half_width"], size)
+		elif dist == "lognormal":
+			values = mean * rng.lognormal(0.0, spec["sigma"], size)
+		else:
+			raise ValueError("Unknown distribution %s for %s/%s" % (dist, kind, name))
+		# coefficients, densities and gravity are never negative
+		return np.maximum(values, 0.0)
+
+	def _drawGrouped(self, kind, mapping, names, draws, rng):
+		'''
+		(N, draws) values for a list of N names, drawn once per name group.
+		'''
+		names = np.asarray(names)
+		out = np.empty((len(names), draws), dtype=float)
+		for name in np.unique(names):
+			idx = np.flatnonzero(names == name)
+			out[idx] = self._drawParameter(kind, str(name), mapping[str(name)],
+										   (len(idx), draws), rng)
+		return out
+
+	def slipProbability(self, slope_materials, block_materials, envs,
+						angles, b_widths, b_heights, b_depths,
+						draws=1000, free=False, seed=None, chunk_size=None):
+		'''
+		Batched Monte Carlo version of slipOrNot (slipOrNotFreePivot with
+		free=True) for N scenes. Friction coefficients, densities and
+		gravity are drawn from the uncertainty config, draws times per
+		scene, and all draws of a chunk of scenes are evaluated at once.
+		As in slipOrNot, accel is (M_slope - friction)/M, so only the
+		friction coefficient moves the label and accel, density and
+		gravity only spread the force.
+		return - {"slip_prob", "accel_mean", "accel_std",
+				  "force_mean", "force_std"}, each (N,)
+		'''
+		rng = np.random.default_rng(seed)
+		angles = np.asarray(angles, dtype=float)
+		if free:
+			angles = np.where(angles <= 45.0, angles, 90 - angles)
+		angle_pi = np.radians(angles)
+		V = (np.broadcast_to(b_widths, angles.shape) *
+			 np.broadcast_to(b_heights, angles.shape) *
+			 np.broadcast_to(b_depths, angles.shape))
+		n = len(angles)
+		if chunk_size is None:
+			# keep every (chunk, draws) array around 32MB
+			chunk_size = max(1, (1 << 22) // draws)
+		out = {key: np.empty(n) for key in
+			   ["slip_prob", "accel_mean", "accel_std", "force_mean", "force_std"]}
+		for start in range(0, n, chunk_size):
+			part = slice(start, min(start + chunk_size, n))
+			mu = self._drawGrouped("friction_coeff", self.materialCoeffMapping,
+								   slope_materials[part], draws, rng)
+			pho = self._drawGrouped("density", self.materialDensityMapping,
+									block_materials[part], draws, rng)
+			g = self._drawGrouped("gravity_accel", self.envGMapping,
+								  envs[part], draws, rng)
+			sin = np.sin(angle_pi[part])[:, None]
+			cos = np.cos(angle_pi[part])[:, None]
+			accel = sin - mu*cos
+			force = pho * V[part][:, None] * g * accel
+			out["slip_prob"][part] = np.mean(accel > 0, axis=1)
+			out["accel_mean"][part] = accel.mean(axis=1)
+			out["accel_std"][part] = accel.std(axis=1)
+			out["force_mean"][part] = force.mean(axis=1)
+			out["force_std"][part] = force.std(axis=1)
+		return out
+
+	def _lookup(self, mapping, names):
+		'''
+		Values of mapping for an array of names, one dict lookup per name.
+		'''
+		vocab, codes = np.unique(np.asarray(names), return_inverse=True)
+		return np.array([mapping[str(name)] for name in vocab], dtype=float)[codes.ravel()].reshape(np.shape(names))
+
+	def slipOrNotBatch(self, slope_materials, block_materials, envs,
+					   angles, b_widths, b_heights, b_depths):
+		'''
+		Vectorized slipOrNot over arrays of blocks.
+		return - (slip, force, accel) arrays, not formatted as strings
+		'''
+		angle_pi = np.radians(np.asarray(angles, dtype=float))
+		V = (np.asarray(b_widths, dtype=float) * np.asarray(b_heights, dtype=float) *
+			 np.asarray(b_depths, dtype=float))
+		M = self._lookup(self.materialDensityMapping, block_materials) * V * \
+			self._lookup(self.envGMapping, envs)
+		M_down = M * np.cos(angle_pi)
+		M_slope = M * np.sin(angle_pi)
+		friction = M_down * self._lookup(self.materialCoeffMapping, slope_materials)
+		force = M_slope - friction
+		return M_slope > friction, force, force / M
+
 	def slipOrNot(self, slope_material, block_material, env,
 				  angle, b_width, b_height, b_depth):
 		'''
@@ -346,10 +778,639 @@ class FrictionSimulationEnginer:
 			accel = "%.3f" % accel
 			return M_slope > friction, force, accel
 
+def polygonMask(poly, size):
+	'''
+	Rasterize a convex polygon given in pixel space by testing every
+	pixel center against each edge half-plane at once.
+	size - (height, width) of the mask
+	'''
+	h, w = size
+	ys = np.arange(h, dtype=float)[:, None] + 0.5
+	xs = np.arange(w, dtype=float)[None, :] + 0.5
+	poly = np.asarray(poly, dtype=float)
+	nxt = np.roll(poly, -1, axis=0)
+	orient = np.sign(np.sum(poly[:, 0]*nxt[:, 1] - nxt[:, 0]*poly[:, 1])) or 1.0
+	mask = np.ones((h, w), dtype=bool)
+	for (a_x, a_y), (b_x, b_y) in zip(poly, nxt):
+		mask &= orient*((b_x - a_x)*(ys - a_y) - (b_y - a_y)*(xs - a_x)) >= 0
+	return mask
+
+def outlineMask(poly, half_width, size):
+	'''
+	Rasterize the closed outline of a polygon given in pixel space, every
+	pixel center within half_width of an edge is set.
+	'''
+	h, w = size
+	ys = np.arange(h, dtype=float)[:, None] + 0.5
+	xs = np.arange(w, dtype=float)[None, :] + 0.5
+	poly = np.asarray(poly, dtype=float)
+	mask = np.zeros((h, w), dtype=bool)
+	for a, b in zip(poly, np.roll(poly, -1, axis=0)):
+		d = b - a
+		t = ((xs - a[0])*d[0] + (ys - a[1])*d[1]) / max(d @ d, 1e-12)
+		t = np.clip(t, 0.0, 1.0)
+		mask |= (xs - a[0] - t*d[0])**2 + (ys - a[1] - t*d[1])**2 <= half_width**2
+	return mask
+
+def framePixels(points, resolution):
+	'''
+	Map data-space points of the 0..FRAME_SIZE frame to pixel space of a
+	resolution x resolution image, origin at the top-left corner.
+	'''
+	points = np.asarray(points, dtype=float)
+	scale = resolution / FRAME_SIZE
+	return np.stack([points[..., 0]*scale,
+					 (FRAME_SIZE - points[..., 1])*scale], axis=-1)
+
+# Palette entries of indexed rasters
+PALETTE_ENV = 0
+PALETTE_SLOPE = 1
+PALETTE_BLOCK = 2
+
+def rasterizeIndex(scene, resolution=256):
+	'''
+	Rasterize the geometry of one SCENE_DTYPE record to a (resolution,
+	resolution) uint8 palette index raster, PALETTE_ENV for the background,
+	PALETTE_SLOPE and PALETTE_BLOCK for the shapes. Colors are ignored.
+	'''
+	return _rasterizeIndexWindow(scene, resolution, 0, 0, resolution, resolution)
+
+def _rasterizeIndexWindow(scene, resolution, x0, y0, x1, y1):
+	'''
+	The [y0:y1, x0:x1] window of rasterizeIndex(scene, resolution).
+	'''
+	size = (y1 - y0, x1 - x0)
+	index = np.full(size, PALETTE_ENV, dtype=np.uint8)
+	tri = framePixels(scene["tri"], resolution) - [x0, y0]
+	rec = framePixels(scene["rec"], resolution) - [x0, y0]
+	if scene["outline"]:
+		half_width = 0.5*STROKE_WIDTH*resolution/FRAME_SIZE
+		index[outlineMask(tri, half_width, size)] = PALETTE_SLOPE
+		index[outlineMask(rec, half_width, size)] = PALETTE_BLOCK
+	else:
+		index[polygonMask(tri, size)] = PALETTE_SLOPE
+		index[polygonMask(rec, size)] = PALETTE_BLOCK
+	return index
+
+def renderSequence(scenes, resolution=256):
+	'''
+	Index rasters of consecutive SCENE_DTYPE records, (T, resolution,
+	resolution) uint8. Every frame starts from the previous one and only
+	the box around the old and new vertices is rasterized again, outside
+	of it both frames are background.
+	'''
+	frames = np.empty((len(scenes), resolution, resolution), dtype=np.uint8)
+	if len(scenes) == 0:
+		return frames
+	frames[0] = rasterizeIndex(scenes[0], resolution)
+	pad = 1 + (0.5*STROKE_WIDTH*resolution/FRAME_SIZE if scenes[0]["outline"] else 0)
+	for t in range(1, len(scenes)):
+		frames[t] = frames[t-1]
+		points = framePixels(np.concatenate([scenes[t-1]["tri"], scenes[t-1]["rec"],
+											 scenes[t]["tri"], scenes[t]["rec"]]),
+							 resolution)
+		x0 = max(int(np.floor(points[:, 0].min() - pad)), 0)
+		y0 = max(int(np.floor(points[:, 1].min() - pad)), 0)
+		x1 = min(int(np.ceil(points[:, 0].max() + pad)), resolution)
+		y1 = min(int(np.ceil(points[:, 1].max() + pad)), resolution)
+		if x1 > x0 and y1 > y0:
+			frames[t, y0:y1, x0:x1] = _rasterizeIndexWindow(scenes[t], resolution,
+															 x0, y0, x1, y1)
+	return frames
+
+def scenePalette(scene):
+	'''
+	return - (3,3) uint8 colors of a record in palette order
+	'''
+	return np.stack([scene["env_color"], scene["slope_color"],
+					 scene["block_color"]]).astype(np.uint8)
+
+def recolor(index, palette):
+	'''
+	Turn a palette index raster into an RGB image with a single lookup.
+	'''
+	return np.asarray(palette, dtype=np.uint8)[index]
+
+def rasterizeScene(scene, resolution=256):
+	'''
+	Rasterize one SCENE_DTYPE record to a (resolution, resolution, 3) uint8
+	image. Filled scenes follow _draw, outline scenes follow _drawBW.
+	'''
+	return recolor(rasterizeIndex(scene, resolution), scenePalette(scene))
+
+def saveIndexedPNG(path, index, palette):
+	'''
+	Store a palette index raster as a paletted PNG. With three entries
+	PIL writes it at 2 bits per pixel.
+	'''
+	image = Image.fromarray(np.ascontiguousarray(index, dtype=np.uint8))
+	image.putpalette(np.asarray(palette, dtype=np.uint8).ravel().tolist())
+	image.save(path, optimize=True)
+
+def loadIndexedPNG(path):
+	'''
+	return - (index raster, (n,3) palette), use recolor for the RGB image
+	'''
+	with Image.open(path) as image:
+		index = np.asarray(image)
+		palette = np.array(image.getpalette(), dtype=np.uint8).reshape(-1, 3)
+	return index, palette[:index.max() + 1]
+
+def writeScenes(out_dir, scenes):
+	'''
+	Store the vector records of a run as one structured array shard,
+	out_dir/scenes.npy, in the same order as the rows of metadata.csv.
+	'''
+	np.save(out_dir + 'scenes.npy', np.array(scenes, dtype=SCENE_DTYPE))
+
+def writeDatasetInfo(out_dir, simulator, free=False):
+	'''
+	Record what a reader needs to interpret metadata.csv in
+	out_dir/dataset.yaml: the friction coefficients the labels were
+	computed with, and whether angles above 45 degrees act as 90-angle,
+	as in slipOrNotFreePivot.
+	'''
+	info = {"free": bool(free),
+			"friction_coeff": {name: float(mu) for name, mu
+							   in simulator.materialCoeffMapping.items()}}
+	with open(out_dir + 'dataset.yaml', mode='w') as _file:
+		yaml.safe_dump(info, _file)
+
+class VectorScenes:
+	'''
+	Lazy loader for a scenes.npy shard. The shard is memory-mapped and a
+	scene is only rasterized, at the requested resolution, when it is read.
+	'''
+	def __init__(self, path, resolution=256):
+		self.scenes = np.load(path, mmap_mode='r')
+		self.resolution = resolution
+
+	def __len__(self):
+		return len(self.scenes)
+
+	def __getitem__(self, index):
+		return rasterizeScene(self.scenes[index], self.resolution)
+
+class LayeredRenderer:
+	'''
+	Raster renderer that caches pre-rasterized background layers, the
+	environment color with the slope already painted on it. The slope
+	only depends on the angle and geometry mode, so sweeps that vary the
+	block at a fixed slope reuse one layer and only composite the block.
+	Layers are evicted least recently used first.
+	'''
+	def __init__(self, resolution=256, capacity=128):
+		self.resolution = resolution
+		self.capacity = capacity
+		self.layers = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def _background(self, scene):
+		size = (self.resolution, self.resolution)
+		key = (scene["tri"].tobytes(), bool(scene["outline"]),
+			   scene["slope_color"].tobytes(), scene["env_color"].tobytes())
+		layer = self.layers.get(key)
+		if layer is not None:
+			self.hits += 1
+			self.layers.move_to_end(key)
+			return layer
+		self.misses += 1
+		layer = np.empty(size + (3,), dtype=np.uint8)
+		layer[:] = scene["env_color"]
+		tri = framePixels(scene["tri"], self.resolution)
+		if scene["outline"]:
+			layer[outlineMask(tri, self._halfWidth(), size)] = scene["slope_color"]
+		else:
+			layer[polygonMask(tri, size)] = scene["slope_color"]
+		layer.setflags(write=False)
+		self.layers[key] = layer
+		if len(self.layers) > self.capacity:
+			self.layers.popitem(last=False)
+		return layer
+
+	def _halfWidth(self):
+		return 0.5*STROKE_WIDTH*self.resolution/FRAME_SIZE
+
+	def render(self, scene):
+		'''
+		Same image as rasterizeScene(scene, resolution), the block mask is
+		only evaluated inside the bounding box of the block.
+		'''
+		image = self._background(scene).copy()
+		rec = framePixels(scene["rec"], self.resolution)
+		pad = self._halfWidth() + 1 if scene["outline"] else 1
+		x0 = max(int(np.floor(rec[:, 0].min() - pad)), 0)
+		y0 = max(int(np.floor(rec[:, 1].min() - pad)), 0)
+		x1 = min(int(np.ceil(rec[:, 0].max() + pad)), self.resolution)
+		y1 = min(int(np.ceil(rec[:, 1].max() + pad)), self.resolution)
+		if x1 <= x0 or y1 <= y0:
+			return image
+		local = rec - [x0, y0]
+		if scene["outline"]:
+			mask = outlineMask(local, self._halfWidth(), (y1 - y0, x1 - x0))
+		else:
+			mask = polygonMask(local, (y1 - y0, x1 - x0))
+		image[y0:y1, x0:x1][mask] = scene["block_color"]
+		return image
+
+def writePackedShard(raw_path, path, shape):
+	'''
+	Turn the rows streamed to raw_path into a .npy shard of uint8 with the
+	given shape, so it can be memory-mapped, and remove raw_path.
+	'''
+	header = {'descr': np.lib.format.dtype_to_descr(np.dtype(np.uint8)),
+			  'fortran_order': False, 'shape': shape}
+	with open(path, 'wb') as out, open(raw_path, 'rb') as src:
+		np.lib.format.write_array_header_1_0(out, header)
+		shutil.copyfileobj(src, out, 1 << 20)
+	os.remove(raw_path)
+
+def compressPackedShard(path, compressed_path):
+	'''
+	Store a packed .npy shard deflate-compressed in compressed_path (.npz)
+	and remove the .npy. Outlines leave long runs of zero bytes, so this is
+	several times smaller, but the shard can no longer be memory-mapped.
+	'''
+	packed = np.load(path, mmap_mode='r')
+	np.savez_compressed(compressed_path, packed=packed)
+	del packed
+	os.remove(path)
+
+def unpackBW(packed, width=None):
+	'''
+	Unpack bit-packed BW images, a single (H, ceil(W/8)) image or any
+	batch of them, into booleans in one call. Images are square unless
+	width is given.
+	'''
+	packed = np.asarray(packed, dtype=np.uint8)
+	if width is None:
+		width = packed.shape[-2]
+	return np.unpackbits(packed, axis=-1, count=width).view(bool)
+
+class PackedBW:
+	'''
+	Reader for a packed.npy shard of BW samples. The shard is
+	memory-mapped and only the requested images are unpacked, index with
+	an int, a slice or an array of sample positions. A compressed
+	packed.npz shard is decompressed into memory once instead.
+	'''
+	def __init__(self, path):
+		if path.endswith('.npz'):
+			with np.load(path) as data:
+				self.packed = data["packed"]
+		else:
+			self.packed = np.load(path, mmap_mode='r')
+
+	def __len__(self):
+		return len(self.packed)
+
+	def __getitem__(self, index):
+		return unpackBW(self.packed[index])
+
+class IndexedRenderer:
+	'''
+	Caches palette index rasters by geometry. Scenes that only differ in
+	slope, block or environment colors are rendered once, every color
+	variant is then just a different palette.
+	'''
+	def __init__(self, resolution=256, capacity=128):
+		self.resolution = resolution
+		self.capacity = capacity
+		self.rasters = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def render(self, scene):
+		key = (scene["tri"].tobytes(), scene["rec"].tobytes(),
+			   bool(scene["outline"]))
+		index = self.rasters.get(key)
+		if index is not None:
+			self.hits += 1
+			self.rasters.move_to_end(key)
+			return index
+		self.misses += 1
+		index = rasterizeIndex(scene, self.resolution)
+		index.setflags(write=False)
+		self.rasters[key] = index
+		if len(self.rasters) > self.capacity:
+			self.rasters.popitem(last=False)
+		return index
+
+def notifySample(args, **info):
+	'''
+	Tell the hooks registered in args.sample_hooks that samples were
+	written. info holds "samples" (count, default 1) and, when known,
+	"label", "bytes", "params" (slope, block, env, angle, b_width,
+	b_height) of the sample, "stages" (seconds spent per output stage:
+	render, save, annotate) and "flushed" for metadata rows written to
+	disk.
+	'''
+	info.setdefault("samples", 1)
+	for hook in getattr(args, 'sample_hooks', []):
+		hook(info)
+
+class SampleWriter:
+	'''
+	Writes the samples of one driver run in the output format selected on
+	the command line. Drivers still own the metadata rows.
+	'''
+	def __init__(self, simulator, args, free=False, out_dir=None):
+		'''
+		free:
+			Description:
+				Use the free pivot geometry. Those samples are always
+				rendered in color, as in simulateFreePivot.
+		out_dir:
+			Description:
+				Overrides the dataset folder, used by the run planner.
+				Defaults to --out-dir if given.
+		'''
+		self.simulator = simulator
+		self.args = args
+		self.free = free
+		self.bw = args.bw and not free
+		if out_dir is None:
+			out_dir = getattr(args, 'out_dir', None)
+		if out_dir is not None:
+			self.out_dir = os.path.join(out_dir, "")
+		elif not self.bw:
+			self.out_dir = "../DATASET/samples/"
+		else:
+			self.out_dir = "../DATASET/samplesBW/"
+		self.annotations = []
+		self.scenes = []
+		self.renderer = None
+		self.indexer = None
+		self.packed = None
+		self.packed_n = 0
+		if args.format == "packed" and not self.bw:
+			raise ValueError("--format packed stores one bit per pixel and needs --bw")
+		if args.compress and args.format != "packed":
+			raise ValueError("--compress only applies to --format packed")
+		if args.format in ["indexed", "packed"]:
+			self.indexer = IndexedRenderer(resolution=args.resolution,
+										   capacity=args.layer_cache)
+		elif args.backend == "layered":
+			self.renderer = LayeredRenderer(resolution=args.resolution,
+											capacity=args.layer_cache)
+
+	def write(self, index, material, angle, b_width, b_height, env,
+			  label, force, accel):
+		'''
+		return - the output name used as the image column of the metadata
+		'''
+		self.stageSeconds = {}
+		self._lapStart = time.perf_counter()
+		output_name = self._write(index, material, angle, b_width, b_height,
+								  env, label, force, accel)
+		if self.args.format == "vector":
+			written = SCENE_DTYPE.itemsize
+		elif self.args.format == "packed":
+			written = self.indexer.resolution*((self.indexer.resolution + 7)//8)
+		else:
+			written = os.path.getsize(self.out_dir + output_name + '.png')
+		self._lap("save")
+		notifySample(self.args, label=label, bytes=written,
+					 params=(material["slope"], material["block"], env,
+							 angle, b_width, b_height),
+					 stages=self.stageSeconds)
+		return output_name
+
+	def _lap(self, stage):
+		'''
+		Add the time since the previous lap of this sample to stage.
+		'''
+		now = time.perf_counter()
+		self.stageSeconds[stage] = (self.stageSeconds.get(stage, 0.0) +
+									now - self._lapStart)
+		self._lapStart = now
+
+	def _write(self, index, material, angle, b_width, b_height, env,
+			   label, force, accel):
+		output_name = "_".join(["ID", str(index), str(label)[0], accel, force])
+		if self.args.format == "vector":
+			scene = self.simulator.sceneRecord(
+								index, material=material, angle=angle,
+								b_width=b_width, b_height=b_height,
+								env=env, free=self.free, bw=self.bw)
+			self.scenes.append(scene)
+			self._lap("render")
+			if self.args.annotate:
+				# annotate the image VectorScenes rasterizes at --resolution
+				record = np.array(scene, dtype=SCENE_DTYPE)
+				keypoints = framePixels(np.concatenate([record["tri"], record["rec"]]),
+										self.args.resolution)
+				self.annotations.append(pixelAnnotation(
+								keypoints, (self.args.resolution,)*2))
+				self._lap("annotate")
+			return output_name
+
+		if self.indexer is not None:
+			scene = np.array(self.simulator.sceneRecord(
+								index, material=material, angle=angle,
+								b_width=b_width, b_height=b_height,
+								env=env, free=self.free, bw=self.bw),
+							 dtype=SCENE_DTYPE)
+			raster = self.indexer.render(scene)
+			self._lap("render")
+			if self.args.format == "packed":
+				if self.packed is None:
+					self.packed = open(self.out_dir + 'packed.bin', 'wb')
+				self.packed.write(np.packbits(raster != PALETTE_ENV, axis=-1).tobytes())
+				self.packed_n += 1
+			else:
+				saveIndexedPNG(self.out_dir + output_name + '.png',
+							   raster, scenePalette(scene))
+			self._lap("save")
+			if self.args.annotate:
+				keypoints = framePixels(np.concatenate([scene["tri"], scene["rec"]]),
+										self.indexer.resolution)
+				if scene["outline"]:
+					# the raster only holds outlines, masks cover the shapes
+					self.annotations.append(pixelAnnotation(keypoints, raster.shape))
+				else:
+					self.annotations.append({
+								"size": raster.shape,
+								"keypoints": keypoints.astype(np.float32),
+								"slope": encodeRLE(raster == PALETTE_SLOPE),
+								"block": encodeRLE(raster == PALETTE_BLOCK)})
+				self._lap("annotate")
+			return output_name
+
+		if self.renderer is not None:
+			scene = np.array(self.simulator.sceneRecord(
+								index, material=material, angle=angle,
+								b_width=b_width, b_height=b_height,
+								env=env, free=self.free, bw=self.bw),
+							 dtype=SCENE_DTYPE)
+			image = self.renderer.render(scene)
+			self._lap("render")
+			plt.imsave(self.out_dir + output_name + '.png', image)
+			self._lap("save")
+			if self.args.annotate:
+				keypoints = framePixels(np.concatenate([scene["tri"], scene["rec"]]),
+										self.renderer.resolution)
+				self.annotations.append(pixelAnnotation(
+								keypoints, (self.renderer.resolution,)*2))
+				self._lap("annotate")
+			return output_name
+
+		if self.free:
+			sample = self.simulator.generateSampleFreePivot(
+								material=material, angle=angle,
+								b_width=b_width, b_height=b_height,
+								env=env, show=False)
+		elif self.bw:
+			sample = self.simulator.generateSampleBW(
+								material=material, angle=angle,
+								b_width=b_width, b_height=b_height,
+								env=env, show=False)
+		else:
+			sample = self.simulator.generateSample(
+								material=material, angle=angle,
+								b_width=b_width, b_height=b_height,
+								env=env, show=False)
+		self._lap("render")
+		sample.savefig(self.out_dir + output_name + '.png',
+					   bbox_inches = 'tight', pad_inches = 0)
+		self._lap("save")
+		if self.args.annotate:
+			# masks take the size of the image they annotate, read from
+			# the PNG header only
+			with Image.open(self.out_dir + output_name + '.png') as png:
+				width, height = png.size
+			self.annotations.append(self.simulator.annotateSample(
+								sample, angle=angle,
+								b_width=b_width, b_height=b_height,
+								free=self.free, size=(height, width)))
+			self._lap("annotate")
+		# a figure per sample is never reused, keep it from piling up
+		sample.close()
+		return output_name
+
+	def writeMetadata(self, headers, rows):
+		'''
+		Write metadata.csv. With --monte-carlo the rows get the slip
+		probability and the spread of accel and force under the
+		uncertainty of the config, next to the point estimate label.
+		'''
+		if self.args.monte_carlo > 0:
+			stats = self.simulator.slipProbability(
+						[row[3] for row in rows], [row[4] for row in rows],
+						[row[5] for row in rows],
+						np.array([row[6] for row in rows], dtype=float),
+						np.array([row[7] for row in rows], dtype=float),
+						np.array([row[8] for row in rows], dtype=float),
+						np.array([row[9] for row in rows], dtype=float),
+						draws=self.args.monte_carlo, free=self.free,
+						seed=self.args.seed)
+			columns = ["slip_prob", "accel_mean", "accel_std",
+					   "force_mean", "force_std"]
+			headers = headers + columns
+			rows = [row + ["%.3f" % stats[c][i] for c in columns]
+					for i, row in enumerate(rows)]
+		with open(self.out_dir + 'metadata.csv', mode='w') as _file:
+			_file_w = csv.writer(_file, delimiter=',')
+			_file_w.writerow(headers)
+			for row in rows:
+				_file_w.writerow(row)
+		writeDatasetInfo(self.out_dir, self.simulator, free=self.free)
+		notifySample(self.args, samples=0, flushed=len(rows))
+
+	def close(self):
+		if self.args.annotate and self.annotations:
+			writeAnnotations(self.out_dir, self.annotations)
+		if self.args.format == "vector":
+			writeScenes(self.out_dir, self.scenes)
+		if self.packed is not None:
+			self.packed.close()
+			self.packed = None
+			resolution = self.indexer.resolution
+			writePackedShard(self.out_dir + 'packed.bin', self.out_dir + 'packed.npy',
+							 (self.packed_n, resolution, (resolution + 7)//8))
+			if self.args.compress:
+				compressPackedShard(self.out_dir + 'packed.npy',
+									self.out_dir + 'packed.npz')
+
+def pixelAnnotation(keypoints, size):
+	'''
+	Masks and keypoints from the seven projected scene vertices, triangle
+	first. The block is drawn on top of the slope, so it is removed from
+	the slope mask.
+	'''
+	block = polygonMask(keypoints[3:], size)
+	slope = polygonMask(keypoints[:3], size) & ~block
+	return {"size": tuple(size),
+			"keypoints": np.asarray(keypoints, dtype=np.float32),
+			"slope": encodeRLE(slope),
+			"block": encodeRLE(block)}
+
+def encodeRLE(mask):
+	'''
+	Run-length encode a boolean mask in row-major order. Runs alternate
+	starting with a run of False, which may be empty.
+	'''
+	flat = np.asarray(mask, dtype=bool).ravel()
+	if flat.size == 0:
+		return np.zeros(0, dtype=np.uint32)
+	changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+	counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+	if flat[0]:
+		counts = np.concatenate(([0], counts))
+	return counts.astype(np.uint32)
+
+def decodeRLE(counts, size):
+	'''
+	Inverse of encodeRLE.
+	size - (height, width) of the mask
+	'''
+	counts = np.asarray(counts, dtype=np.int64)
+	values = (np.arange(len(counts)) % 2).astype(bool)
+	return np.repeat(values, counts).reshape(size)
+
+def writeAnnotations(out_dir, annotations):
+	'''
+	Store the annotations of a run in out_dir/annotations.npz, in the same
+	order as the rows of metadata.csv. RLE counts of every sample are
+	concatenated, sample i owns counts[offsets[i]:offsets[i+1]].
+	'''
+	out = {"size": np.array([a["size"] for a in annotations], dtype=np.int32).reshape(-1, 2),
+		   "keypoints": np.array([a["keypoints"] for a in annotations],
+								 dtype=np.float32).reshape(-1, 7, 2)}
+	for key in ["slope", "block"]:
+		counts = [a[key] for a in annotations]
+		out[key + "_offsets"] = np.cumsum([0] + [len(c) for c in counts]).astype(np.int64)
+		out[key + "_counts"] = (np.concatenate(counts) if counts
+								else np.zeros(0, dtype=np.uint32))
+	np.savez_compressed(out_dir + 'annotations.npz', **out)
+
+def loadAnnotation(path, index, image_path=None):
+	'''
+	Decode the masks and keypoints of one sample from annotations.npz.
+	image_path - the PNG of the sample, if given the masks are checked to
+		have its shape
+	'''
+	data = np.load(path)
+	size = tuple(int(v) for v in data["size"][index])
+	if image_path is not None:
+		with Image.open(image_path) as image:
+			width, height = image.size
+		if size != (height, width):
+			raise ValueError("Annotation %d is %dx%d but %s is %dx%d" % (
+							 index, size[1], size[0], image_path, width, height))
+	out = {"size": size, "keypoints": data["keypoints"][index]}
+	for key in ["slope", "block"]:
+		offsets = data[key + "_offsets"]
+		counts = data[key + "_counts"][offsets[index]:offsets[index+1]]
+		out[key] = decodeRLE(counts, size)
+	return out
+
 def simulateNormal(simulator, args):
 
 	B_DEPTH = 3
 	SAMPLE_N = 12000
+	writer = SampleWriter(simulator, args)
 
 	labels = []
 	headers = ["image", "label", "accel", "slope_material", "block_material",
@@ -369,46 +1430,24 @@ def simulateNormal(simulator, args):
 									angle, b_width, b_height, b_depth)
 		labels.append(label)
 
-		out_dir = ""
-		if not args.bw:
-			out_dir = "../DATASET/samples/"
-			sample = simulator.generateSample(
-								material={
-									"block":block_material,
-									"slope":slope_material},
-								angle=angle,
-								b_width=b_width, b_height=b_height,
-								env=env,
-								show=False)
-		else:
-			out_dir = "../DATASET/samplesBW/"
-			sample = simulator.generateSampleBW(
-								material={
-									"block":block_material,
-									"slope":slope_material},
-								angle=angle,
-								b_width=b_width, b_height=b_height,
-								env=env,
-								show=False)			
-		output_name = "_".join(["ID", str(i), str(label)[0], accel, force])
-		sample.savefig(out_dir + output_name + '.png',
-					   bbox_inches = 'tight', pad_inches = 0)
+		output_name = writer.write(i, {"block":block_material,
+											"slope":slope_material},
+										 angle, b_width, b_height, env,
+										 label, force, accel)
 		row = [output_name, str(label), accel, slope_material, block_material,
 			   env, str(angle), str(b_width), str(b_height), str(b_depth)]
 		rows.append(row)
 	# print(sum(labels))
 	print("Wiriting metadata to a file...")
 	# write metadata as well
-	with open(out_dir + 'metadata.csv', mode='w') as _file:
-		_file_w = csv.writer(_file, delimiter=',')
-		_file_w.writerow(headers)
-		for row in rows:
-			_file_w.writerow(row)
+	writer.writeMetadata(headers, rows)
+	writer.close()
 
 def simulateFreePivot(simulator, args):
 
 	B_DEPTH = 3
 	SAMPLE_N = 12000
+	writer = SampleWriter(simulator, args, free=True)
 
 	labels = []
 	headers = ["image", "label", "accel", "slope_material", "block_material",
@@ -428,35 +1467,24 @@ def simulateFreePivot(simulator, args):
 									angle, b_width, b_height, b_depth)
 		labels.append(label)
 
-		out_dir = ""
-		out_dir = "../DATASET/samples/"
-		sample = simulator.generateSampleFreePivot(
-							material={
-								"block":block_material,
-								"slope":slope_material},
-							angle=angle,
-							b_width=b_width, b_height=b_height,
-							env=env,
-							show=False)		
-		output_name = "_".join(["ID", str(i), str(label)[0], accel, force])
-		sample.savefig(out_dir + output_name + '.png',
-					   bbox_inches = 'tight', pad_inches = 0)
+		output_name = writer.write(i, {"block":block_material,
+											"slope":slope_material},
+										 angle, b_width, b_height, env,
+										 label, force, accel)
 		row = [output_name, str(label), accel, slope_material, block_material,
 			   env, str(angle), str(b_width), str(b_height), str(b_depth)]
 		rows.append(row)
 	# print(sum(labels))
 	print("Wiriting metadata to a file...")
 	# write metadata as well
-	with open(out_dir + 'metadata.csv', mode='w') as _file:
-		_file_w = csv.writer(_file, delimiter=',')
-		_file_w.writerow(headers)
-		for row in rows:
-			_file_w.writerow(row)
+	writer.writeMetadata(headers, rows)
+	writer.close()
 
 def simulateSlope(simulator, args):
 
 	B_DEPTH = 3
 	SAMPLE_N = 100
+	writer = SampleWriter(simulator, args)
 
 	labels = []
 	headers = ["image", "label", "accel", "slope_material", "block_material",
@@ -482,30 +1510,10 @@ def simulateSlope(simulator, args):
 										angle, b_width, b_height, b_depth)
 			labels.append(label)
 
-			out_dir = ""
-			if not args.bw:
-				out_dir = "../DATASET/samples/"
-				sample = simulator.generateSample(
-									material={
-										"block":block_material,
-										"slope":slope_material},
-									angle=angle,
-									b_width=b_width, b_height=b_height,
-									env=env,
-									show=False)
-			else:
-				out_dir = "../DATASET/samplesBW/"
-				sample = simulator.generateSampleBW(
-									material={
-										"block":block_material,
-										"slope":slope_material},
-									angle=angle,
-									b_width=b_width, b_height=b_height,
-									env=env,
-									show=False)			
-			output_name = "_".join(["ID", str(index), str(label)[0], accel, force])
-			sample.savefig(out_dir + output_name + '.png',
-						bbox_inches = 'tight', pad_inches = 0)
+			output_name = writer.write(index, {"block":block_material,
+												"slope":slope_material},
+											 angle, b_width, b_height, env,
+											 label, force, accel)
 			row = [output_name, str(label), accel, slope_material, block_material,
 				env, str(angle), str(b_width), str(b_height), str(b_depth)]
 			rows.append(row)
@@ -513,16 +1521,14 @@ def simulateSlope(simulator, args):
 	# print(sum(labels))
 	print("Wiriting metadata to a file...")
 	# write metadata as well
-	with open(out_dir + 'metadata.csv', mode='w') as _file:
-		_file_w = csv.writer(_file, delimiter=',')
-		_file_w.writerow(headers)
-		for row in rows:
-			_file_w.writerow(row)
+	writer.writeMetadata(headers, rows)
+	writer.close()
 
 def simulateBlock(simulator, args):
 
 	B_DEPTH = 3
 	SAMPLE_N = 100
+	writer = SampleWriter(simulator, args)
 
 	labels = []
 	headers = ["image", "label", "accel", "slope_material", "block_material",
@@ -548,30 +1554,10 @@ def simulateBlock(simulator, args):
 										angle, b_width, b_height, b_depth)
 			labels.append(label)
 
-			out_dir = ""
-			if not args.bw:
-				out_dir = "../DATASET/samples/"
-				sample = simulator.generateSample(
-									material={
-										"block":block_material,
-										"slope":slope_material},
-									angle=angle,
-									b_width=b_width, b_height=b_height,
-									env=env,
-									show=False)
-			else:
-				out_dir = "../DATASET/samplesBW/"
-				sample = simulator.generateSampleBW(
-									material={
-										"block":block_material,
-										"slope":slope_material},
-									angle=angle,
-									b_width=b_width, b_height=b_height,
-									env=env,
-									show=False)			
-			output_name = "_".join(["ID", str(index), str(label)[0], accel, force])
-			sample.savefig(out_dir + output_name + '.png',
-						bbox_inches = 'tight', pad_inches = 0)
+			output_name = writer.write(index, {"block":block_material,
+												"slope":slope_material},
+											 angle, b_width, b_height, env,
+											 label, force, accel)
 			row = [output_name, str(label), accel, slope_material, block_material,
 				env, str(angle), str(b_width), str(b_height), str(b_depth)]
 			rows.append(row)
@@ -579,16 +1565,14 @@ def simulateBlock(simulator, args):
 	# print(sum(labels))
 	print("Wiriting metadata to a file...")
 	# write metadata as well
-	with open(out_dir + 'metadata.csv', mode='w') as _file:
-		_file_w = csv.writer(_file, delimiter=',')
-		_file_w.writerow(headers)
-		for row in rows:
-			_file_w.writerow(row)
+	writer.writeMetadata(headers, rows)
+	writer.close()
 
 def simulateEnv(simulator, args):
 
 	B_DEPTH = 3
 	SAMPLE_N = 100
+	writer = SampleWriter(simulator, args)
 
 	labels = []
 	headers = ["image", "label", "accel", "slope_material", "block_material",
@@ -614,30 +1598,10 @@ def simulateEnv(simulator, args):
 										angle, b_width, b_height, b_depth)
 			labels.append(label)
 
-			out_dir = ""
-			if not args.bw:
-				out_dir = "../DATASET/samples/"
-				sample = simulator.generateSample(
-									material={
-										"block":block_material,
-										"slope":slope_material},
-									angle=angle,
-									b_width=b_width, b_height=b_height,
-									env=env,
-									show=False)
-			else:
-				out_dir = "../DATASET/samplesBW/"
-				sample = simulator.generateSampleBW(
-									material={
-										"block":block_material,
-										"slope":slope_material},
-									angle=angle,
-									b_width=b_width, b_height=b_height,
-									env=env,
-									show=False)			
-			output_name = "_".join(["ID", str(index), str(label)[0], accel, force])
-			sample.savefig(out_dir + output_name + '.png',
-						bbox_inches = 'tight', pad_inches = 0)
+			output_name = writer.write(index, {"block":block_material,
+												"slope":slope_material},
+											 angle, b_width, b_height, env,
+											 label, force, accel)
 			row = [output_name, str(label), accel, slope_material, block_material,
 				env, str(angle), str(b_width), str(b_height), str(b_depth)]
 			rows.append(row)
@@ -645,16 +1609,14 @@ def simulateEnv(simulator, args):
 	# print(sum(labels))
 	print("Wiriting metadata to a file...")
 	# write metadata as well
-	with open(out_dir + 'metadata.csv', mode='w') as _file:
-		_file_w = csv.writer(_file, delimiter=',')
-		_file_w.writerow(headers)
-		for row in rows:
-			_file_w.writerow(row)
+	writer.writeMetadata(headers, rows)
+	writer.close()
 
 def simulateBlockFixed(simulator, args):
 
 	B_DEPTH = 3
 	SAMPLE_N = 100
+	writer = SampleWriter(simulator, args)
 
 	labels = []
 	headers = ["image", "label", "accel", "slope_material", "block_material",
@@ -682,30 +1644,10 @@ def simulateBlockFixed(simulator, args):
 										angle, b_width, b_height, b_depth)
 			labels.append(label)
 
-			out_dir = ""
-			if not args.bw:
-				out_dir = "../DATASET/samples/"
-				sample = simulator.generateSample(
-									material={
-										"block":block_material,
-										"slope":slope_material},
-									angle=angle,
-									b_width=b_width, b_height=b_height,
-									env=env,
-									show=False)
-			else:
-				out_dir = "../DATASET/samplesBW/"
-				sample = simulator.generateSampleBW(
-									material={
-										"block":block_material,
-										"slope":slope_material},
-									angle=angle,
-									b_width=b_width, b_height=b_height,
-									env=env,
-									show=False)			
-			output_name = "_".join(["ID", str(index), str(label)[0], accel, force])
-			sample.savefig(out_dir + output_name + '.png',
-						bbox_inches = 'tight', pad_inches = 0)
+			output_name = writer.write(index, {"block":block_material,
+												"slope":slope_material},
+											 angle, b_width, b_height, env,
+											 label, force, accel)
 			row = [output_name, str(label), accel, slope_material, block_material,
 				env, str(angle), str(b_width), str(b_height), str(b_depth)]
 			rows.append(row)
@@ -713,16 +1655,14 @@ def simulateBlockFixed(simulator, args):
 	# print(sum(labels))
 	print("Wiriting metadata to a file...")
 	# write metadata as well
-	with open(out_dir + 'metadata.csv', mode='w') as _file:
-		_file_w = csv.writer(_file, delimiter=',')
-		_file_w.writerow(headers)
-		for row in rows:
-			_file_w.writerow(row)
+	writer.writeMetadata(headers, rows)
+	writer.close()
 
 def simulateSlopeFixed(simulator, args):
 
 	B_DEPTH = 3
 	SAMPLE_N = 100
+	writer = SampleWriter(simulator, args)
 
 	labels = []
 	headers = ["image", "label", "accel", "slope_material", "block_material",
@@ -750,30 +1690,10 @@ def simulateSlopeFixed(simulator, args):
 										angle, b_width, b_height, b_depth)
 			labels.append(label)
 
-			out_dir = ""
-			if not args.bw:
-				out_dir = "../DATASET/samples/"
-				sample = simulator.generateSample(
-									material={
-										"block":block_material,
-										"slope":slope_material},
-									angle=angle,
-									b_width=b_width, b_height=b_height,
-									env=env,
-									show=False)
-			else:
-				out_dir = "../DATASET/samplesBW/"
-				sample = simulator.generateSampleBW(
-									material={
-										"block":block_material,
-										"slope":slope_material},
-									angle=angle,
-									b_width=b_width, b_height=b_height,
-									env=env,
-									show=False)			
-			output_name = "_".join(["ID", str(index), str(label)[0], accel, force])
-			sample.savefig(out_dir + output_name + '.png',
-						bbox_inches = 'tight', pad_inches = 0)
+			output_name = writer.write(index, {"block":block_material,
+												"slope":slope_material},
+											 angle, b_width, b_height, env,
+											 label, force, accel)
 			row = [output_name, str(label), accel, slope_material, block_material,
 				env, str(angle), str(b_width), str(b_height), str(b_depth)]
 			rows.append(row)
@@ -781,16 +1701,14 @@ def simulateSlopeFixed(simulator, args):
 	# print(sum(labels))
 	print("Wiriting metadata to a file...")
 	# write metadata as well
-	with open(out_dir + 'metadata.csv', mode='w') as _file:
-		_file_w = csv.writer(_file, delimiter=',')
-		_file_w.writerow(headers)
-		for row in rows:
-			_file_w.writerow(row)
+	writer.writeMetadata(headers, rows)
+	writer.close()
 
 def simulateEnvFixed(simulator, args):
 
 	B_DEPTH = 3
 	SAMPLE_N = 100
+	writer = SampleWriter(simulator, args)
 
 	labels = []
 	headers = ["image", "label", "accel", "slope_material", "block_material",
@@ -818,30 +1736,10 @@ def simulateEnvFixed(simulator, args):
 										angle, b_width, b_height, b_depth)
 			labels.append(label)
 
-			out_dir = ""
-			if not args.bw:
-				out_dir = "../DATASET/samples/"
-				sample = simulator.generateSample(
-									material={
-										"block":block_material,
-										"slope":slope_material},
-									angle=angle,
-									b_width=b_width, b_height=b_height,
-									env=env,
-									show=False)
-			else:
-				out_dir = "../DATASET/samplesBW/"
-				sample = simulator.generateSampleBW(
-									material={
-										"block":block_material,
-										"slope":slope_material},
-									angle=angle,
-									b_width=b_width, b_height=b_height,
-									env=env,
-									show=False)			
-			output_name = "_".join(["ID", str(index), str(label)[0], accel, force])
-			sample.savefig(out_dir + output_name + '.png',
-						bbox_inches = 'tight', pad_inches = 0)
+			output_name = writer.write(index, {"block":block_material,
+												"slope":slope_material},
+											 angle, b_width, b_height, env,
+											 label, force, accel)
 			row = [output_name, str(label), accel, slope_material, block_material,
 				env, str(angle), str(b_width), str(b_height), str(b_depth)]
 			rows.append(row)
@@ -849,16 +1747,14 @@ def simulateEnvFixed(simulator, args):
 	# print(sum(labels))
 	print("Wiriting metadata to a file...")
 	# write metadata as well
-	with open(out_dir + 'metadata.csv', mode='w') as _file:
-		_file_w = csv.writer(_file, delimiter=',')
-		_file_w.writerow(headers)
-		for row in rows:
-			_file_w.writerow(row)
+	writer.writeMetadata(headers, rows)
+	writer.close()
 
 def simulateDemo(simulator, args):
 
 	B_DEPTH = 3
 	SAMPLE_N = 100
+	writer = SampleWriter(simulator, args)
 
 	labels = []
 	headers = ["image", "label", "accel", "slope_material", "block_material",
@@ -885,30 +1781,10 @@ def simulateDemo(simulator, args):
 										angle, b_width, b_height, b_depth)
 			labels.append(label)
 
-			out_dir = ""
-			if not args.bw:
-				out_dir = "../DATASET/samples/"
-				sample = simulator.generateSample(
-									material={
-										"block":block_material,
-										"slope":slope_material},
-									angle=angle,
-									b_width=b_width, b_height=b_height,
-									env=env,
-									show=False)
-			else:
-				out_dir = "../DATASET/samplesBW/"
-				sample = simulator.generateSampleBW(
-									material={
-										"block":block_material,
-										"slope":slope_material},
-									angle=angle,
-									b_width=b_width, b_height=b_height,
-									env=env,
-									show=False)			
-			output_name = "_".join(["ID", str(index), str(label)[0], accel, force])
-			sample.savefig(out_dir + output_name + '.png',
-						bbox_inches = 'tight', pad_inches = 0)
+			output_name = writer.write(index, {"block":block_material,
+												"slope":slope_material},
+											 angle, b_width, b_height, env,
+											 label, force, accel)
 			row = [output_name, str(label), accel, slope_material, block_material,
 				env, str(angle), str(b_width), str(b_height), str(b_depth)]
 			rows.append(row)
@@ -916,11 +1792,744 @@ def simulateDemo(simulator, args):
 	# print(sum(labels))
 	print("Wiriting metadata to a file...")
 	# write metadata as well
+	writer.writeMetadata(headers, rows)
+	writer.close()
+
+def rejectWriterFlags(args, scenario):
+	'''
+	Drivers that write their own outputs instead of using a SampleWriter
+	raise on the output flags they would otherwise ignore.
+	'''
+	unsupported = []
+	if args.format != "png":
+		unsupported.append("--format " + args.format)
+	if args.backend != "matplotlib":
+		unsupported.append("--backend " + args.backend)
+	if args.compress:
+		unsupported.append("--compress")
+	if args.annotate:
+		unsupported.append("--annotate")
+	if args.monte_carlo > 0:
+		unsupported.append("--monte-carlo")
+	if unsupported:
+		raise ValueError("--scenario %s does not support %s" % (
+						 scenario, ", ".join(unsupported)))
+
+def simulateTiltTable(simulator, args):
+
+	B_DEPTH = 3
+	rejectWriterFlags(args, "tiltTable")
+	B_SIZES = [(2, 2), (3, 3)]
+
+	if args.out_dir is not None:
+		out_dir = os.path.join(args.out_dir, "")
+	elif not args.bw:
+		out_dir = "../DATASET/sequences/"
+	else:
+		out_dir = "../DATASET/sequencesBW/"
+	headers = ["sequence", "slope_material", "block_material", "env",
+			   "b_width", "b_height", "b_depth", "frames",
+			   "critical_angle", "onset_frame"]
+	rows = []
+
+	index = 0
+
+	angles = np.array([ i*0.5 for i in range (1, 100)])
+
+	for slope_m in list(materialCoeffMapping.keys()):
+		print("Generating sequences with slope material: " + slope_m + " ...")
+		critical_angle = math.degrees(math.atan(materialCoeffMapping[slope_m]))
+		# first frame past the critical angle, -1 if it never slips
+		onset_frame = int(np.searchsorted(angles, critical_angle, side='right'))
+		if onset_frame == len(angles):
+			onset_frame = -1
+
+		for block_m in list(materialDensityMapping.keys()):
+			for env in list(envGMapping.keys()):
+				for b_width, b_height in B_SIZES:
+					material = {"block":block_m, "slope":slope_m}
+					start = time.perf_counter()
+					tris, recs, _ = simulator.sceneGeometryBatch(
+										angles, b_width, b_height)
+					scenes = np.zeros(len(angles), dtype=SCENE_DTYPE)
+					scenes[:] = simulator.sceneRecord(
+										index, material=material,
+										angle=angles[0],
+										b_width=b_width, b_height=b_height,
+										env=env, bw=args.bw)
+					scenes["id"] = np.arange(len(angles))
+					scenes["tri"] = tris
+					scenes["rec"] = recs
+					render = time.perf_counter() - start
+					labels, accels = [], []
+					for angle in angles:
+						label, force, accel = simulator.slipOrNot(
+											slope_m, block_m, env,
+											angle, b_width, b_height, B_DEPTH)
+						labels.append(label)
+						accels.append(float(accel))
+					start = time.perf_counter()
+					frames = renderSequence(scenes, args.resolution)
+					render += time.perf_counter() - start
+
+					output_name = "_".join(["SEQ", str(index), slope_m, block_m, env])
+					start = time.perf_counter()
+					np.savez_compressed(out_dir + output_name + '.npz',
+										frames=frames,
+										palette=scenePalette(scenes[0]),
+										angles=angles,
+										labels=np.array(labels),
+										accel=np.array(accels),
+										onset_frame=onset_frame)
+					save = time.perf_counter() - start
+					rows.append([output_name, slope_m, block_m, env,
+								 str(b_width), str(b_height), str(B_DEPTH),
+								 str(len(angles)), "%.3f" % critical_angle,
+								 str(onset_frame)])
+					notifySample(args, samples=len(angles),
+								 bytes=os.path.getsize(out_dir + output_name + '.npz'),
+								 stages={"render": render, "save": save})
+					index += 1
+	print("Wiriting metadata to a file...")
+	# write metadata as well
+	with open(out_dir + 'metadata.csv', mode='w') as _file:
+		_file_w = csv.writer(_file, delimiter=',')
+		_file_w.writerow(headers)
+		for row in rows:
+			_file_w.writerow(row)
+	# one row per sequence, the hooks count frames
+	notifySample(args, samples=0, flushed=len(rows)*len(angles))
+
+def loadSequence(path):
+	'''
+	return - (RGB frames (T,H,W,3), {"angles", "labels", "accel",
+			  "onset_frame"}) of a tilt table sequence
+	'''
+	with np.load(path) as data:
+		frames = recolor(data["frames"], data["palette"])
+		info = {key: data[key] for key in ["angles", "labels", "accel"]}
+		info["onset_frame"] = int(data["onset_frame"])
+	return frames, info
+
+def simulateMultiBlock(simulator, args):
+
+	B_DEPTH = 3
+	SAMPLE_N = 1000
+	BLOCK_N = 3
+	rejectWriterFlags(args, "multiBlock")
+
+	if args.out_dir is not None:
+		out_dir = os.path.join(args.out_dir, "")
+	elif not args.bw:
+		out_dir = "../DATASET/multiblock/"
+	else:
+		out_dir = "../DATASET/multiblockBW/"
+	headers = ["image", "block", "label", "accel", "slope_material",
+			   "block_material", "env", "angle", "b_width", "b_height",
+			   "b_depth", "offset"]
+	rows = []
+
+	scenes = simulator.sampleMultiBlock(SAMPLE_N, BLOCK_N)
+	slope_materials = np.array([random.choice(list(materialCoeffMapping.keys()))
+								for _ in range(SAMPLE_N)])
+	block_materials = np.array([[random.choice(list(materialDensityMapping.keys()))
+								 for _ in range(BLOCK_N)] for _ in range(SAMPLE_N)])
+	envs = np.array([random.choice(list(envGMapping.keys()))
+					 for _ in range(SAMPLE_N)])
+	# every block of every scene in one physics call
+	labels, forces, accels = simulator.slipOrNotBatch(
+								np.repeat(slope_materials[:, None], BLOCK_N, axis=1),
+								block_materials,
+								np.repeat(envs[:, None], BLOCK_N, axis=1),
+								np.repeat(scenes["angle"][:, None], BLOCK_N, axis=1),
+								scenes["b_width"], scenes["b_height"], B_DEPTH)
+
+	for i in tqdm(range(SAMPLE_N)):
+		start = time.perf_counter()
+		sample = simulator._drawMulti(scenes["tri"][i], scenes["rec"][i],
+									  material={"slope":slope_materials[i],
+												"block":list(block_materials[i])},
+									  env=envs[i], bw=args.bw)
+		output_name = "_".join(["ID", str(i),
+								"".join(str(bool(l))[0] for l in labels[i])])
+		render = time.perf_counter() - start
+		sample.savefig(out_dir + output_name + '.png',
+					   bbox_inches = 'tight', pad_inches = 0)
+		plt.close()
+		notifySample(args, label=bool(labels[i].any()),
+					 bytes=os.path.getsize(out_dir + output_name + '.png'),
+					 stages={"render": render,
+							 "save": time.perf_counter() - start - render})
+		for b in range(BLOCK_N):
+			rows.append([output_name, str(b), str(bool(labels[i, b])),
+						 "%.3f" % accels[i, b], slope_materials[i],
+						 block_materials[i, b], envs[i],
+						 str(scenes["angle"][i]), str(scenes["b_width"][i, b]),
+						 str(scenes["b_height"][i, b]), str(B_DEPTH),
+						 str(scenes["offset"][i, b])])
+	print("Wiriting metadata to a file...")
+	# write metadata as well
 	with open(out_dir + 'metadata.csv', mode='w') as _file:
 		_file_w = csv.writer(_file, delimiter=',')
 		_file_w.writerow(headers)
 		for row in rows:
 			_file_w.writerow(row)
+	writeDatasetInfo(out_dir, simulator)
+	# one row per block, the hooks count scenes
+	notifySample(args, samples=0, flushed=SAMPLE_N)
+
+SCENARIOS = {"normal": simulateNormal,
+			 "freePivot": simulateFreePivot,
+			 "slope": simulateSlope,
+			 "block": simulateBlock,
+			 "env": simulateEnv,
+			 "blockFixed": simulateBlockFixed,
+			 "slopeFixed": simulateSlopeFixed,
+			 "envFixed": simulateEnvFixed,
+			 "demo": simulateDemo,
+			 "tiltTable": simulateTiltTable,
+			 "multiBlock": simulateMultiBlock}
+
+def scenarioSampleCount(scenario):
+	'''
+	Number of samples a scenario writes with the loaded config.
+	'''
+	counts = {"normal": 12000,
+			  "freePivot": 12000,
+			  "slope": 100*len(materialCoeffMapping),
+			  "block": 100*len(materialDensityMapping),
+			  "env": 100*len(envGMapping),
+			  "blockFixed": 99*len(materialDensityMapping),
+			  "slopeFixed": 99*len(materialCoeffMapping),
+			  "envFixed": 99*len(envGMapping),
+			  "demo": 5*len(materialCoeffMapping),
+			  "tiltTable": 99*2*len(materialCoeffMapping)*
+						   len(materialDensityMapping)*len(envGMapping),
+			  "multiBlock": 1000}
+	return counts[scenario]
+
+def currentRSS():
+	'''
+	Resident set size of this process in bytes.
+	'''
+	try:
+		with open('/proc/self/statm') as _file:
+			return int(_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (OSError, ValueError):
+		return peakRSS()
+
+def peakRSS(who=resource.RUSAGE_SELF):
+	'''
+	Peak resident set size of this process in bytes, or of the largest
+	finished child process with resource.RUSAGE_CHILDREN.
+	'''
+	peak = resource.getrusage(who).ru_maxrss
+	# kilobytes on linux, bytes on mac
+	return peak if sys.platform == 'darwin' else peak * 1024
+
+def folderBytes(folder, since=0.0):
+	'''
+	Total size of the files in folder modified at or after since.
+	'''
+	total = 0
+	if not os.path.isdir(folder):
+		return total
+	for entry in os.scandir(folder):
+		if entry.is_file() and entry.stat().st_mtime >= since:
+			total += entry.stat().st_size
+	return total
+
+class _CalibrationDone(Exception):
+	'''
+	Raised from the capture hook once enough parameter tuples were seen.
+	'''
+	pass
+
+def _scenarioDraws(simulator, args, n):
+	'''
+	The first n (slope, block, env, angle, b_width, b_height) tuples
+	args.scenario writes, in order, captured from a vector run of the
+	driver that is stopped early. Scenarios with fewer samples give all
+	of them.
+	'''
+	draws = []
+	def capture(info):
+		if "params" in info:
+			draws.append(info["params"])
+			if len(draws) >= n:
+				raise _CalibrationDone()
+	tmp_dir = tempfile.mkdtemp(prefix="friction_draws_")
+	probe = copy.copy(args)
+	probe.format = "vector"
+	probe.compress = False
+	probe.backend = "matplotlib"
+	probe.annotate = False
+	probe.monte_carlo = 0
+	probe.out_dir = tmp_dir
+	probe.sample_hooks = [capture]
+	try:
+		with contextlib.redirect_stdout(io.StringIO()):
+			SCENARIOS[args.scenario](simulator, probe)
+	except _CalibrationDone:
+		pass
+	finally:
+		shutil.rmtree(tmp_dir, ignore_errors=True)
+	return draws
+
+def _cacheBytes(writer):
+	'''
+	return - (bytes, entries) held by the raster or layer cache of a writer
+	'''
+	if writer.indexer is not None:
+		cache = writer.indexer.rasters
+	elif writer.renderer is not None:
+		cache = writer.renderer.layers
+	else:
+		return 0, 0
+	return sum(value.nbytes for value in cache.values()), len(cache)
+
+def calibrateStages(simulator, args, free=False, calibration_n=20):
+	'''
+	Run the first calibration_n samples of args.scenario through every
+	stage on this machine, with the same SampleWriter the drivers use,
+	writing into a temporary folder. The samples keep the order of the
+	scenario, so cached backends see the hit rate of a real run.
+	RSS is only read while tracemalloc is stopped, so its own trace
+	storage is not counted.
+	return - {"seconds": per-sample seconds of each stage,
+			  "bytes": per-sample output bytes,
+			  "warmup": one-off memory of the first samples (figures,
+						font cache), outside the caches,
+			  "cache_entry": bytes of one raster or layer cache entry,
+			  "retained": per-sample memory kept until the end of a run,
+			  "transient": extra peak memory while a sample is written}
+	'''
+	B_DEPTH = 3
+	slip = simulator.slipOrNotFreePivot if free else simulator.slipOrNot
+	tmp_dir = tempfile.mkdtemp(prefix="friction_plan_")
+	rss_start = currentRSS()
+	# calibration samples are not part of the run, keep them from the hooks
+	args = copy.copy(args)
+	args.sample_hooks = []
+	try:
+		seconds = {}
+		draws = _scenarioDraws(simulator, args, calibration_n)
+		if not draws:
+			raise ValueError("Scenario %s writes no samples" % args.scenario)
+		calibration_n = len(draws)
+
+		start = time.perf_counter()
+		results = [slip(s, b, e, a, w, h, B_DEPTH) for s, b, e, a, w, h in draws]
+		seconds["physics"] = (time.perf_counter() - start) / calibration_n
+		if args.monte_carlo > 0:
+			start = time.perf_counter()
+			columns = list(zip(*draws))
+			simulator.slipProbability(columns[0], columns[1], columns[2],
+									  np.array(columns[3]), np.array(columns[4]),
+									  np.array(columns[5]), B_DEPTH,
+									  draws=args.monte_carlo, free=free)
+			seconds["monte_carlo"] = (time.perf_counter() - start) / calibration_n
+
+		# timing pass
+		writer = SampleWriter(simulator, args, free=free,
+							  out_dir=os.path.join(tmp_dir, "time", ""))
+		os.makedirs(writer.out_dir)
+		rows = []
+		start = time.perf_counter()
+		for i, ((s, b, e, a, w, h), (label, force, accel)) in enumerate(zip(draws, results)):
+			name = writer.write(i, {"block":b, "slope":s}, a, w, h, e,
+								label, force, accel)
+			rows.append([name, str(label), accel, s, b, e,
+						 str(a), str(w), str(h), str(B_DEPTH)])
+		seconds["sample"] = (time.perf_counter() - start) / calibration_n
+		start = time.perf_counter()
+		writer.close()
+		metadata = io.StringIO()
+		csv.writer(metadata, delimiter=',').writerows(rows)
+		seconds["finalize"] = (time.perf_counter() - start) / calibration_n
+		plt.close('all')
+		sample_bytes = (folderBytes(writer.out_dir) +
+						len(metadata.getvalue())) / calibration_n
+		# what the timing pass left behind besides its cache is paid once
+		warmup = max(currentRSS() - rss_start - _cacheBytes(writer)[0], 0)
+		del writer, rows
+
+		# memory pass, rows are kept the way the drivers keep them. The
+		# first samples only warm up, retained memory is the RSS slope over
+		# the later ones with the cache taken out, the last ones are traced
+		# for the transient peak.
+		writer = SampleWriter(simulator, args, free=free,
+							  out_dir=os.path.join(tmp_dir, "memory", ""))
+		os.makedirs(writer.out_dir)
+		rows = []
+		warmup_n = max(1, calibration_n // 4)
+		traced_n = max(1, calibration_n // 4)
+		points = []
+		transient = 0
+		for i, ((s, b, e, a, w, h), (label, force, accel)) in enumerate(zip(draws, results)):
+			traced = i >= calibration_n - traced_n
+			if traced:
+				tracemalloc.start()
+				traced_before = tracemalloc.get_traced_memory()[0]
+			name = writer.write(i, {"block":b, "slope":s}, a, w, h, e,
+								label, force, accel)
+			rows.append([name, str(label), accel, s, b, e,
+						 str(a), str(w), str(h), str(B_DEPTH)])
+			if traced:
+				transient = max(transient, tracemalloc.get_traced_memory()[1] -
+											traced_before)
+				tracemalloc.stop()
+			elif i >= warmup_n:
+				points.append((i, currentRSS() - _cacheBytes(writer)[0]))
+		cache_bytes, cache_entries = _cacheBytes(writer)
+		writer.close()
+		plt.close('all')
+		retained = max(_growthPer1k(points) / 1000, 0.0)
+	finally:
+		shutil.rmtree(tmp_dir, ignore_errors=True)
+	return {"seconds": seconds, "bytes": sample_bytes, "warmup": warmup,
+			"cache_entry": cache_bytes / cache_entries if cache_entries else 0.0,
+			"retained": retained, "transient": transient}
+
+def planRun(simulator, args, sample_n=None, calibration_n=20):
+	'''
+	Predict wall time, peak memory and output bytes of args.scenario with
+	the selected backend and format, from a short calibration. The
+	drivers run on one process, which is what wall_time and peak_memory
+	predict. With args.workers above 1 the plan also holds a hypothetical
+	workers_wall_time and workers_peak_memory, assuming workers split the
+	per-sample rendering evenly while each of them holds its own
+	transient memory.
+	'''
+	if args.scenario in ["tiltTable", "multiBlock"]:
+		raise ValueError("The planner only covers the per-sample drivers")
+	free = args.scenario == "freePivot"
+	if sample_n is None:
+		sample_n = scenarioSampleCount(args.scenario)
+	workers = max(1, args.workers)
+	rss_start = currentRSS()
+	cal = calibrateStages(simulator, args, free=free,
+						  calibration_n=calibration_n)
+	seconds = cal["seconds"]
+	cache_n = min(sample_n, args.layer_cache)
+	def predict(workers):
+		wall_time = sample_n*(seconds["physics"] + seconds["finalize"] +
+							  seconds.get("monte_carlo", 0.0) +
+							  seconds["sample"]/workers)
+		peak_memory = (rss_start + cal["warmup"] + cache_n*cal["cache_entry"] +
+					   sample_n*cal["retained"] + workers*cal["transient"])
+		return wall_time, peak_memory
+	wall_time, peak_memory = predict(1)
+	plan = {"scenario": args.scenario, "sample_n": sample_n,
+			"workers": workers, "backend": args.backend,
+			"format": args.format, "stages": seconds,
+			"wall_time": wall_time, "peak_memory": peak_memory,
+			"output_bytes": sample_n*cal["bytes"]}
+	if workers > 1:
+		plan["workers_wall_time"], plan["workers_peak_memory"] = predict(workers)
+	return plan
+
+def measureRun(out_dir):
+	'''
+	Run the command line of this process again without --report, in a
+	fresh process, so the measured peak memory does not include the
+	calibration that ran here. The time includes the start of the
+	interpreter.
+	return - {"wall_time", "peak_memory", "output_bytes"} of the run
+	'''
+	argv = [arg for arg in sys.argv[1:] if arg != '--report']
+	start_clock = time.time()
+	start = time.perf_counter()
+	subprocess.run([sys.executable, os.path.abspath(sys.argv[0])] + argv,
+				   check=True)
+	return {"wall_time": time.perf_counter() - start,
+			"peak_memory": peakRSS(resource.RUSAGE_CHILDREN),
+			"output_bytes": folderBytes(out_dir, since=start_clock)}
+
+def _humanBytes(n):
+	for unit in ["B", "KB", "MB", "GB"]:
+		if abs(n) < 1024.0:
+			return "%.1f %s" % (n, unit)
+		n /= 1024.0
+	return "%.1f TB" % n
+
+def reportPlan(plan, actual=None):
+	'''
+	Print a plan, and how it compares to the measured run if given.
+	'''
+	print("\n===   Run plan  ===")
+	print("scenario: %s, samples: %d, workers: %d, backend: %s, format: %s" % (
+		  plan["scenario"], plan["sample_n"], plan["workers"],
+		  plan["backend"], plan["format"]))
+	for stage, sec in plan["stages"].items():
+		print("  %-10s %8.2f ms/sample" % (stage, sec*1000))
+	rows = [("wall time", "%.1f s" % plan["wall_time"],
+			 actual and "%.1f s" % actual["wall_time"]),
+			("peak memory", _humanBytes(plan["peak_memory"]),
+			 actual and _humanBytes(actual["peak_memory"])),
+			("output", _humanBytes(plan["output_bytes"]),
+			 actual and _humanBytes(actual["output_bytes"]))]
+	for name, predicted, measured in rows:
+		if actual is None:
+			print("%-12s %12s" % (name, predicted))
+		else:
+			print("%-12s %12s  actual %12s" % (name, predicted, measured))
+	if "workers_wall_time" in plan:
+		# the drivers do not run in parallel, this is never measured
+		print("hypothetical with %d workers: %.1f s, %s peak memory" % (
+			  plan["workers"], plan["workers_wall_time"],
+			  _humanBytes(plan["workers_peak_memory"])))
+	print("======================")
+
+class SoakFinished(Exception):
+	'''
+	Raised from the soak hook once enough samples were written.
+	'''
+	pass
+
+def _growthPer1k(points):
+	'''
+	Least squares slope of (samples, bytes) points, in bytes per 1k samples.
+	'''
+	if len(points) < 2:
+		return 0.0
+	n, value = np.array(points, dtype=float).T
+	if np.ptp(n) == 0:
+		return 0.0
+	return np.polyfit(n, value, 1)[0] * 1000
+
+def soakTest(simulator, args):
+	'''
+	Drive args.scenario, rerunning it if needed, until args.soak samples
+	were written. RSS and tracemalloc are sampled every args.soak_interval
+	samples, the first interval is skipped as warmup. The run fails when
+	RSS or traced memory grows faster than args.soak_threshold MB per 1k
+	samples, and the allocation sites that grew most are reported.
+	Samples go to a temporary folder unless --out-dir is given.
+	return - True if memory stayed under the threshold
+	'''
+	target = args.soak
+	interval = max(1, args.soak_interval)
+	tmp_dir = None
+	if args.out_dir is None:
+		tmp_dir = tempfile.mkdtemp(prefix="friction_soak_")
+		args.out_dir = tmp_dir
+	state = {"n": 0, "next": interval, "baseline": None}
+	rss_points, traced_points = [], []
+	def hook(info):
+		state["n"] += info["samples"]
+		if state["baseline"] is None and state["n"] >= interval:
+			# compare allocations against the state after warmup
+			state["baseline"] = tracemalloc.take_snapshot()
+		if state["n"] >= state["next"]:
+			state["next"] += interval
+			rss_points.append((state["n"], currentRSS()))
+			traced_points.append((state["n"], tracemalloc.get_traced_memory()[0]))
+			print("soak: %d samples, rss %s, traced %s" % (
+				  state["n"], _humanBytes(rss_points[-1][1]),
+				  _humanBytes(traced_points[-1][1])))
+		if state["n"] >= target:
+			raise SoakFinished()
+
+	# one frame per allocation is enough for a report by line
+	tracemalloc.start()
+	args.sample_hooks.append(hook)
+	try:
+		while True:
+			SCENARIOS[args.scenario](simulator, args)
+	except SoakFinished:
+		pass
+	finally:
+		args.sample_hooks.remove(hook)
+		snapshot = tracemalloc.take_snapshot()
+		tracemalloc.stop()
+		plt.close('all')
+		if tmp_dir is not None:
+			shutil.rmtree(tmp_dir, ignore_errors=True)
+			args.out_dir = None
+
+	threshold = args.soak_threshold * 1024 * 1024
+	rss_growth = _growthPer1k(rss_points[1:])
+	traced_growth = _growthPer1k(traced_points[1:])
+	print("\n===   Soak test  ===")
+	print("scenario: %s, samples: %d" % (args.scenario, state["n"]))
+	print("rss growth:    %s per 1k samples" % _humanBytes(rss_growth))
+	print("traced growth: %s per 1k samples" % _humanBytes(traced_growth))
+	print("Top growing allocation sites since warmup:")
+	if state["baseline"] is not None:
+		grown = [stat for stat in snapshot.compare_to(state["baseline"], 'lineno')
+				 if stat.size_diff > 0]
+		grown.sort(key=lambda stat: stat.size_diff, reverse=True)
+		for stat in grown[:10]:
+			print("  " + str(stat))
+	passed = rss_growth <= threshold and traced_growth <= threshold
+	print("PASSED" if passed else
+		  "FAILED, threshold is %.1f MB per 1k samples" % args.soak_threshold)
+	print("======================")
+	return passed
+
+class Telemetry:
+	'''
+	Live throughput metrics of a run. Registered as a sample hook, it only
+	updates counters per sample and emits a snapshot every interval
+	seconds, as a JSON line to path and as Prometheus text on
+	http://127.0.0.1:port/metrics.
+	'''
+	# simulator methods timed by instrument, by stage, and whether a call
+	# covers a batch of samples along its first argument. The output
+	# stages (render, save, annotate) are timed by the writers and come in
+	# with each sample, so together the stages cover the whole sample time.
+	STAGES = {"slipOrNot": ("physics", False),
+			  "slipOrNotFreePivot": ("physics", False),
+			  "slipOrNotBatch": ("physics", True)}
+
+	def __init__(self, path=None, port=None, interval=10.0, total=None):
+		'''
+		total:
+			Description:
+				Expected number of samples, used for the ETA.
+		'''
+		self.interval = interval
+		self.total = total
+		self.start = time.monotonic()
+		self.lastEmit = self.start
+		self.lastSamples = 0
+		self.samples = 0
+		self.flushed = 0
+		self.bytes = 0
+		self.labels = {"True": 0, "False": 0}
+		# stage -> [calls, seconds], total and since the last snapshot
+		self.stages = {}
+		self.window = {}
+		self.latest = {}
+		self._file = open(path, 'a') if path else None
+		self._server = None
+		if port:
+			self._serve(port)
+
+	def instrument(self, simulator):
+		'''
+		Time the stage methods of a simulator instance.
+		'''
+		for name, (stage, batched) in self.STAGES.items():
+			setattr(simulator, name, self._timed(stage, batched,
+												 getattr(simulator, name)))
+
+	def _timed(self, stage, batched, fn):
+		def timed(*args, **kwargs):
+			# latencies are per sample, a batch call counts its samples
+			calls = len(args[0]) if batched and np.ndim(args[0]) else 1
+			start = time.perf_counter()
+			try:
+				return fn(*args, **kwargs)
+			finally:
+				self._addStage(stage, calls, time.perf_counter() - start)
+		return timed
+
+	def _addStage(self, stage, calls, seconds):
+		for table in [self.stages, self.window]:
+			entry = table.setdefault(stage, [0, 0.0])
+			entry[0] += calls
+			entry[1] += seconds
+
+	def __call__(self, info):
+		self.samples += info["samples"]
+		for stage, seconds in info.get("stages", {}).items():
+			self._addStage(stage, info["samples"], seconds)
+		self.flushed += info.get("flushed", 0)
+		self.bytes += info.get("bytes", 0)
+		if "label" in info:
+			self.labels[str(bool(info["label"]))] += 1
+		now = time.monotonic()
+		if now - self.lastEmit >= self.interval:
+			self.emit(now)
+
+	def snapshot(self, now=None):
+		if now is None:
+			now = time.monotonic()
+		elapsed = max(now - self.start, 1e-9)
+		window = max(now - self.lastEmit, 1e-9)
+		rate = self.samples / elapsed
+		eta = None
+		if self.total is not None and rate > 0:
+			eta = max(self.total - self.samples, 0) / rate
+		return {"time": time.time(),
+				"elapsed": elapsed,
+				"samples": self.samples,
+				"samples_per_sec": rate,
+				"window_samples_per_sec": (self.samples - self.lastSamples) / window,
+				"stage_latency_ms": {stage: 1000*seconds/calls
+									 for stage, (calls, seconds) in self.window.items()},
+				"queues": {"pending_metadata_rows": self.samples - self.flushed,
+						   "open_figures": len(plt.get_fignums())},
+				"bytes_written": self.bytes,
+				"labels": dict(self.labels),
+				"eta": eta}
+
+	def emit(self, now=None):
+		if now is None:
+			now = time.monotonic()
+		self.latest = self.snapshot(now)
+		if self._file is not None:
+			self._file.write(json.dumps(self.latest) + "\n")
+			self._file.flush()
+		self.lastEmit = now
+		self.lastSamples = self.samples
+		self.window = {}
+
+	def prometheus(self):
+		'''
+		Latest metrics in the Prometheus text exposition format.
+		'''
+		latest = self.latest or self.snapshot()
+		lines = ["# TYPE friction_samples_total counter",
+				 "friction_samples_total %d" % self.samples,
+				 "# TYPE friction_bytes_written_total counter",
+				 "friction_bytes_written_total %d" % self.bytes,
+				 "# TYPE friction_samples_per_second gauge",
+				 "friction_samples_per_second %f" % latest["window_samples_per_sec"],
+				 "# TYPE friction_labels_total counter"]
+		for label, count in sorted(self.labels.items()):
+			lines.append('friction_labels_total{label="%s"} %d' % (label, count))
+		lines += ["# TYPE friction_stage_seconds_total counter"]
+		for stage, (calls, seconds) in sorted(self.stages.items()):
+			lines.append('friction_stage_seconds_total{stage="%s"} %f' % (stage, seconds))
+		lines += ["# TYPE friction_stage_calls_total counter"]
+		for stage, (calls, seconds) in sorted(self.stages.items()):
+			lines.append('friction_stage_calls_total{stage="%s"} %d' % (stage, calls))
+		lines += ["# TYPE friction_queue_depth gauge"]
+		for queue, depth in sorted(latest["queues"].items()):
+			lines.append('friction_queue_depth{queue="%s"} %d' % (queue, depth))
+		if latest["eta"] is not None:
+			lines += ["# TYPE friction_eta_seconds gauge",
+					  "friction_eta_seconds %f" % latest["eta"]]
+		return "\n".join(lines) + "\n"
+
+	def _serve(self, port):
+		telemetry = self
+		class Handler(http.server.BaseHTTPRequestHandler):
+			def do_GET(self):
+				body = telemetry.prometheus().encode()
+				self.send_response(200)
+				self.send_header("Content-Type", "text/plain; version=0.0.4")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, *args):
+				pass
+		self._server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+		threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+	def close(self):
+		self.emit()
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+		if self._server is not None:
+			self._server.shutdown()
+			self._server.server_close()
+			self._server = None
 
 if __name__ == "__main__":
 	pp = pprint.PrettyPrinter(indent=4)
@@ -932,7 +2541,54 @@ if __name__ == "__main__":
                         help='flag to only black and white simulations. all colors will be overwrite to black and white.')
 	parser.add_argument('--free', action='store_true', default=False,
                         help='flag to free up the slope and block default positions')
+	parser.add_argument('--annotate', action='store_true', default=False,
+                        help='flag to also write segmentation masks and keypoints to annotations.npz')
+	parser.add_argument('--format', choices=['png', 'vector', 'indexed', 'packed'], default='png',
+                        help='png renders every sample, vector only stores vertices and colors to scenes.npy, '
+                             'indexed renders each geometry once and writes paletted PNGs, '
+                             'packed (--bw only) stores 1 bit per pixel in packed.npy')
+	parser.add_argument('--compress', action='store_true', default=False,
+                        help='with --format packed, store a deflate-compressed packed.npz instead of '
+                             'the memory-mappable packed.npy')
+	parser.add_argument('--backend', choices=['matplotlib', 'layered'], default='matplotlib',
+                        help='renderer used for png samples, layered caches the slope background and only draws the block')
+	parser.add_argument('--resolution', type=int, default=256,
+                        help='image size in pixels of the raster renderers')
+	parser.add_argument('--layer-cache', type=int, default=128,
+                        help='number of cached entries, background layers of the layered renderer or geometry '
+                             'rasters of --format indexed/packed')
+	parser.add_argument('--scenario', choices=list(SCENARIOS.keys()), default='slopeFixed',
+                        help='which simulate* driver to run')
+	parser.add_argument('--plan', action='store_true', default=False,
+                        help='dry run, calibrate on this machine and print the predicted cost of the run')
+	parser.add_argument('--report', action='store_true', default=False,
+                        help='plan, run, then print predicted versus actual cost')
+	parser.add_argument('--monte-carlo', type=int, default=0,
+                        help='number of draws per sample from the uncertainty config, adds slip probability and accel/force spread to the metadata')
+	parser.add_argument('--seed', type=int, default=None,
+                        help='seed of the Monte Carlo draws')
+	parser.add_argument('--out-dir', default=None,
+                        help='write the dataset to this folder instead of ../DATASET/...')
+	parser.add_argument('--soak', type=int, default=0,
+                        help='memory soak test, run the scenario for this many samples and check memory growth')
+	parser.add_argument('--soak-interval', type=int, default=100,
+                        help='samples between two memory measurements of the soak test')
+	parser.add_argument('--soak-threshold', type=float, default=5.0,
+                        help='allowed memory growth of the soak test in MB per 1k samples')
+	parser.add_argument('--telemetry', default=None,
+                        help='append live throughput metrics as JSON lines to this file')
+	parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve the live metrics as Prometheus text on 127.0.0.1:PORT/metrics')
+	parser.add_argument('--telemetry-interval', type=float, default=10.0,
+                        help='seconds between two telemetry snapshots')
+	parser.add_argument('--workers', type=int, default=1,
+                        help='number of workers for a hypothetical parallel run, only reported by the '
+                             'run planner since the drivers run on one process')
 	args = parser.parse_args()
+	args.sample_hooks = []
+	if (args.plan or args.report) and args.scenario in ["tiltTable", "multiBlock"]:
+		parser.error("--plan and --report only cover the per-sample scenarios, not %s"
+					 % args.scenario)
 
 	print("Starting Simulations...")
 	property_list = None
@@ -962,8 +2618,34 @@ if __name__ == "__main__":
 										  materialDensityMapping, 
 										  materialColorMapping, 
 										  envGMapping,
-										  envColorMapping)
+										  envColorMapping,
+										  property_list.get('uncertainty'))
+	telemetry = None
+	# planning runs no samples of its own, with --report the measured run
+	# in the child process has the telemetry
+	if (args.telemetry or args.metrics_port) and not (args.plan or args.report):
+		telemetry = Telemetry(path=args.telemetry, port=args.metrics_port,
+							  interval=args.telemetry_interval,
+							  total=args.soak or scenarioSampleCount(args.scenario))
+		telemetry.instrument(simulator)
+		args.sample_hooks.append(telemetry)
+
 	# if not args.free:
 	# 	simulateNormal(simulator, args)
 	# else:
-	simulateSlopeFixed(simulator, args)
\ No newline at end of file
+	try:
+		if args.soak > 0:
+			if not soakTest(simulator, args):
+				sys.exit(1)
+		elif args.plan:
+			reportPlan(planRun(simulator, args))
+		elif args.report:
+			plan = planRun(simulator, args)
+			out_dir = SampleWriter(simulator, args,
+								   free=args.scenario == "freePivot").out_dir
+			reportPlan(plan, measureRun(out_dir))
+		else:
+			SCENARIOS[args.scenario](simulator, args)
+	finally:
+		if telemetry is not None:
+			telemetry.close()